@@ -7,57 +7,238 @@ https://opensource.org/license/MIT.
 """
 
 # Manually calibrate camera using folder of previouly captured images
-# Outputs camera matrix and distortion coefficients to json file and command line
+# Outputs camera matrix and distortion coefficients for each image resolution to json file and command line
+# Board detections are cached per image in the captures folder, so later runs only detect new or changed images
 
+import argparse
 import cv2
 import os
 import numpy
 import time
 import json
 import datetime
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 
-images_path = os.getcwd() + "/captures"
-output_file_name = "./src/config/data/calibration.json"
-dictionary = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_5X5_100)
-board = cv2.aruco.CharucoBoard((12,9), 0.03, 0.023, dictionary)
-charucoDetector = cv2.aruco.CharucoDetector(board)
+FAMILY_DICT = {
+    '4X4_50': cv2.aruco.DICT_4X4_50,
+    '4X4_100': cv2.aruco.DICT_4X4_100,
+    '4X4_250': cv2.aruco.DICT_4X4_250,
+    '4X4_1000': cv2.aruco.DICT_4X4_1000,
+    '5X5_50': cv2.aruco.DICT_5X5_50,
+    '5X5_100': cv2.aruco.DICT_5X5_100,
+    '5X5_250': cv2.aruco.DICT_5X5_250,
+    '5X5_1000': cv2.aruco.DICT_5X5_1000,
+    '6X6_50': cv2.aruco.DICT_6X6_50,
+    '6X6_100': cv2.aruco.DICT_6X6_100,
+    '6X6_250': cv2.aruco.DICT_6X6_250,
+    '6X6_1000': cv2.aruco.DICT_6X6_1000,
+    '7X7_50': cv2.aruco.DICT_7X7_50,
+    '7X7_100': cv2.aruco.DICT_7X7_100,
+    '7X7_250': cv2.aruco.DICT_7X7_250,
+    '7X7_1000': cv2.aruco.DICT_7X7_1000,
+    'ARUCO_ORIGINAL': cv2.aruco.DICT_ARUCO_ORIGINAL,
+}
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+CACHE_FILE_NAME = "calibration_cache.json"
+# Fewest ChArUco corners a view needs to constrain its own pose
+MIN_CORNERS = 6
+# Fewest views to calibrate a resolution from
+MIN_VIEWS = 3
+# Views under this reprojection error in pixels are never pruned
+MIN_PRUNE_ERROR = 0.5
+# Convergence threshold of the final solve when it starts from the pruning solve's intrinsics
+WARM_START_EPS = 1e-9
+
+charucoDetector = None
+
+def makeBoard(dictionary_name: str, board_params):
+    dictionary = cv2.aruco.getPredefinedDictionary(FAMILY_DICT[dictionary_name])
+    return cv2.aruco.CharucoBoard((int(board_params[0]), int(board_params[1])), board_params[2], board_params[3], dictionary)
 
-allCorners = []
-allIDs = []
-imsize = None
-time_start = time.time()
-i = 0
+def initWorker(dictionary_name: str, board_params) -> None:
+    # OpenCV objects can't be pickled, so each worker builds its own detector, and runs it on one thread
+    global charucoDetector
+    cv2.setNumThreads(1)
+    charucoDetector = cv2.aruco.CharucoDetector(makeBoard(dictionary_name, board_params))
 
-print("Starting calibration using images in " + images_path)
+def detect(path: str) -> dict:
+    """Detects the board in one image and returns its ChArUco corners and IDs as lists, or None if the board was not found."""
+    image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return {"size": None, "corners": None, "ids": None}
 
-for image in os.listdir(images_path):
-    image = cv2.imread(images_path + "/" + image)
     charucoCorners, charucoIDs, markerCorners, markerIDs = charucoDetector.detectBoard(image)
-    
-    if charucoCorners is not None and charucoIDs is not None:
-        allCorners.append(charucoCorners)
-        allIDs.append(charucoIDs)
-
-    if i == 0: imsize = (image.shape[0], image.shape[1])
-    i += 1
-
-retval, camera_matrix, distortion_coefficient, rvecs, tvecs = cv2.aruco.calibrateCameraCharuco(allCorners, allIDs, board, imsize, None, None)
-
-print("Calibration complete for " + str(i) + " images in " + str(time.time() - time_start) + " seconds")
-print("Camera Matrix")
-print(camera_matrix)
-print("Distortion Coefficients")
-print(distortion_coefficient)
-
-output = {
-    "number_of_images": i,
-    "timestamp": str(datetime.datetime.now()),
-    "resolution": imsize,
-    "camera_matrix": numpy.ndarray.tolist(camera_matrix),
-    "distortion_coefficient": numpy.ndarray.tolist(distortion_coefficient)
-}
 
-with open(output_file_name, "w") as file:
-    file.write(json.dumps(output, indent=4))
+    if charucoCorners is None or charucoIDs is None or len(charucoIDs) < MIN_CORNERS:
+        return {"size": [image.shape[0], image.shape[1]], "corners": None, "ids": None}
+    return {"size": [image.shape[0], image.shape[1]], "corners": charucoCorners.reshape(-1, 2).tolist(), "ids": charucoIDs.flatten().tolist()}
+
+def imageKey(path: str, board_key: str) -> str:
+    with open(path, "rb") as file:
+        return hashlib.sha1(file.read() + board_key.encode()).hexdigest()
+
+def loadCache(path: str) -> dict:
+    if not os.path.isfile(path):
+        return {}
+    with open(path, "r") as file:
+        return json.load(file)
+
+def calibrate(views: list, board, imsize, camera_matrix=None, distortion_coefficient=None):
+    """
+    Runs calibrateCameraCharuco on the given views and returns the camera matrix and distortion coefficients.
+    Given a camera matrix and distortion coefficients, starts from them and stops once the parameters change by less
+    than WARM_START_EPS, which lands on the same solution as a cold solve in a fraction of the iterations.
+    """
+    corners = [numpy.array(view["corners"], dtype=numpy.float32).reshape(-1, 1, 2) for view in views]
+    ids = [numpy.array(view["ids"], dtype=numpy.int32).reshape(-1, 1) for view in views]
+    if camera_matrix is None:
+        retval, camera_matrix, distortion_coefficient, rvecs, tvecs = cv2.aruco.calibrateCameraCharuco(corners, ids, board, imsize, None, None)
+    else:
+        retval, camera_matrix, distortion_coefficient, rvecs, tvecs = cv2.aruco.calibrateCameraCharuco(
+            corners, ids, board, imsize, camera_matrix.copy(), distortion_coefficient.copy(), flags=cv2.CALIB_USE_INTRINSIC_GUESS,
+            criteria=(cv2.TERM_CRITERIA_COUNT + cv2.TERM_CRITERIA_EPS, 30, WARM_START_EPS))
+    return camera_matrix, distortion_coefficient
+
+def viewErrors(views: list, board, camera_matrix, distortion_coefficient):
+    """RMS reprojection error of each view, with its board pose solved against fixed intrinsics."""
+    errors = []
+    for view in views:
+        object_points, image_points = board.matchImagePoints(numpy.array(view["corners"], dtype=numpy.float32).reshape(-1, 1, 2),
+                                                             numpy.array(view["ids"], dtype=numpy.int32).reshape(-1, 1))
+        _, rvec, tvec = cv2.solvePnP(object_points, image_points, camera_matrix, distortion_coefficient, flags=cv2.SOLVEPNP_SQPNP)
+        _, rvec, tvec = cv2.solvePnP(object_points, image_points, camera_matrix, distortion_coefficient, rvec, tvec, True, cv2.SOLVEPNP_ITERATIVE)
+        projected, _ = cv2.projectPoints(object_points, rvec, tvec, camera_matrix, distortion_coefficient)
+        errors.append(numpy.sqrt(numpy.mean(numpy.sum((projected - image_points) ** 2, axis=2))))
+    return numpy.array(errors)
+
+def spread(views: list, count: int) -> list:
+    """Evenly spaced views across the capture session, since the solve's cost grows with the cube of the number of views."""
+    if count <= 0 or len(views) <= count:
+        return views
+    return [views[i] for i in numpy.linspace(0, len(views) - 1, count).round().astype(int)]
+
+def prune(views: list, board, imsize, factor: float, max_rounds: int, prune_views: int, max_views: int):
+    """
+    Calibrates from at most prune_views views, then repeatedly drops views whose reprojection error is more than factor
+    times the median and recalibrates. Every view is checked against each solve, even those left out of it. The kept
+    views are then solved together once more, at most max_views of them, starting from the last pruning solve.
+    Returns the kept views, the camera matrix, distortion coefficients, RMS error over the kept views and the pruned image names.
+    """
+    solved = spread(views, prune_views)
+    camera_matrix, distortion_coefficient = calibrate(solved, board, imsize)
+    errors = viewErrors(views, board, camera_matrix, distortion_coefficient)
+    pruned = []
+
+    for _ in range(max_rounds):
+        bound = max(factor * numpy.median(errors), MIN_PRUNE_ERROR)
+        keep = [view for view, error in zip(views, errors) if error <= bound]
+        if len(keep) == len(views) or len(keep) < MIN_VIEWS:
+            break
+
+        kept = set(view["image"] for view in keep)
+        pruned += [view["image"] for view in views if view["image"] not in kept]
+        views = keep
+        solved = spread(views, prune_views)
+        camera_matrix, distortion_coefficient = calibrate(solved, board, imsize)
+        errors = viewErrors(views, board, camera_matrix, distortion_coefficient)
+
+    final = spread(views, max_views)
+    if len(final) != len(solved):
+        camera_matrix, distortion_coefficient = calibrate(final, board, imsize, camera_matrix, distortion_coefficient)
+        errors = viewErrors(views, board, camera_matrix, distortion_coefficient)
+
+    return views, camera_matrix, distortion_coefficient, float(numpy.sqrt(numpy.mean(errors ** 2))), pruned
+
+if __name__ == '__main__':
+    with open("./src/config/data/config.json", "r") as config_file:
+        config_data = json.load(config_file)
+
+    parser = argparse.ArgumentParser(description="Calibrate the camera from previously captured images of the ChArUco board.")
+    parser.add_argument("--images", default=os.getcwd() + "/captures", help="folder of captured board images")
+    parser.add_argument("--output", default="./src/config/data/calibration.json", help="calibration file to write, calibrations for other resolutions in it are kept")
+    parser.add_argument("--replace", action="store_true", help="drop the calibrations already in the output file")
+    parser.add_argument("--dictionary", default=config_data["calibration_dictionary"], choices=FAMILY_DICT.keys(), help="board dictionary, defaults to calibration_dictionary in config.json")
+    parser.add_argument("--board", type=float, nargs=4, default=config_data["charuco_board"], metavar=("SQUARES_X", "SQUARES_Y", "SQUARE_LENGTH", "MARKER_LENGTH"),
+                        help="board parameters, defaults to charuco_board in config.json")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="number of detection processes")
+    parser.add_argument("--max-views", type=int, default=0, help="solve the final intrinsics from at most this many views spread across the captures, 0 uses every view")
+    parser.add_argument("--prune-views", type=int, default=50, help="solve each pruning round from at most this many views spread across the captures, 0 uses every view")
+    parser.add_argument("--prune-factor", type=float, default=2.0, help="drop views whose reprojection error is more than this times the median")
+    parser.add_argument("--prune-rounds", type=int, default=3, help="rounds of pruning, 0 keeps every view")
+    parser.add_argument("--no-cache", action="store_true", help="detect every image again and leave the cache untouched")
+    args = parser.parse_args()
+
+    images_path = args.images
+    cache_path = os.path.join(images_path, CACHE_FILE_NAME)
+    board = makeBoard(args.dictionary, args.board)
+    # Normalize the board so 12 and 12.0 share cache entries
+    board_key = args.dictionary + ":" + ",".join([str(int(value)) for value in args.board[:2]] + [repr(float(value)) for value in args.board[2:]])
+    time_start = time.time()
+
+    print("Starting calibration using images in " + images_path)
+
+    paths = sorted(os.path.join(images_path, name) for name in os.listdir(images_path) if name.lower().endswith(IMAGE_EXTENSIONS))
+    keys = [imageKey(path, board_key) for path in paths]
+
+    cache = {} if args.no_cache else loadCache(cache_path)
+    missing = [(path, key) for path, key in zip(paths, keys) if key not in cache]
+
+    if len(missing) > 0:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=initWorker, initargs=(args.dictionary, args.board)) as executor:
+            for (path, key), detection in zip(missing, executor.map(detect, [path for path, _ in missing], chunksize=4)):
+                cache[key] = detection
+
+    print("Detected the board in " + str(len(missing)) + " new images (" + str(len(paths) - len(missing)) + " cached) in " + str(round(time.time() - time_start, 2)) + " seconds")
+
+    if not args.no_cache:
+        # Only keep entries for images still in the folder, so the cache doesn't grow forever
+        with open(cache_path, "w") as file:
+            file.write(json.dumps({key: cache[key] for key in keys}))
+
+    views = [dict(cache[key], image=os.path.basename(path)) for path, key in zip(paths, keys) if cache[key]["corners"] is not None]
+    if len(views) == 0:
+        raise RuntimeError("The board was not found in any image in " + images_path)
+
+    # Calibrations are kept per resolution, so calibrate each resolution in the folder on its own and keep the rest of the file
+    calibrations = []
+    if os.path.isfile(args.output) and not args.replace:
+        with open(args.output, "r") as file:
+            data = json.load(file)
+        calibrations = [calibration for calibration in (data["calibrations"] if "calibrations" in data else [data]) if calibration.get("resolution") is not None]
+
+    for imsize in sorted(set(tuple(view["size"]) for view in views), reverse=True):
+        resolution_views = [view for view in views if tuple(view["size"]) == imsize]
+        if len(resolution_views) < MIN_VIEWS:
+            print("Skipping " + str(imsize[1]) + "x" + str(imsize[0]) + ", the board was only found in " + str(len(resolution_views)) + " images")
+            continue
+
+        resolution_views, camera_matrix, distortion_coefficient, retval, pruned = prune(resolution_views, board, (imsize[1], imsize[0]), args.prune_factor, args.prune_rounds, args.prune_views, args.max_views)
+
+        print("Calibration complete for " + str(len(resolution_views)) + " " + str(imsize[1]) + "x" + str(imsize[0]) + " images in " + str(round(time.time() - time_start, 2)) + " seconds")
+        if len(pruned) > 0:
+            print("Pruned " + str(len(pruned)) + " images with high reprojection error: " + ", ".join(pruned))
+        print("Reprojection Error")
+        print(retval)
+        print("Camera Matrix")
+        print(camera_matrix)
+        print("Distortion Coefficients")
+        print(distortion_coefficient)
+
+        calibrations = [calibration for calibration in calibrations if list(calibration["resolution"]) != list(imsize)]
+        calibrations.append({
+            "number_of_images": len(resolution_views),
+            "timestamp": str(datetime.datetime.now()),
+            "resolution": imsize,
+            "reprojection_error": retval,
+            "camera_matrix": numpy.ndarray.tolist(camera_matrix),
+            "distortion_coefficient": numpy.ndarray.tolist(distortion_coefficient)
+        })
+
+    calibrations.sort(key=lambda calibration: calibration["resolution"][0] * calibration["resolution"][1], reverse=True)
+
+    with open(args.output, "w") as file:
+        file.write(json.dumps({"calibrations": calibrations}, indent=4))
 
-print("Wrote calibration data to " + output_file_name)
\ No newline at end of file
+    print("Wrote calibrations for " + ", ".join(str(c["resolution"][1]) + "x" + str(c["resolution"][0]) for c in calibrations) + " to " + args.output)
@@ -6,16 +6,22 @@ license that can be found in the LICENSE file or at
 https://opensource.org/license/MIT.
 """
 
-import time, cv2
+import os, time, cv2
+from concurrent.futures import ThreadPoolExecutor
 
 from config.Config import Config, LocalConfig, RemoteConfig
 from config.ConfigManager import FileConfigManager, NTConfigManager
 from output.Annotate import AnnotateFiducials
+from output.Metrics import Metrics
 from output.Stream import MJPGServer
 from output.Publisher import NTPublisher
+from pipeline.Camera import Camera
 from pipeline.Capture import DefaultCapture
 from pipeline.Detector import FiducialDetector
-from pipeline.PoseEstimator import FiducialPoseEstimator
+from pipeline.ExposureController import ExposureController
+from pipeline.Pipeline import FrameData, Pipeline
+from pipeline.PoseEstimator import FiducialLayout, FiducialPoseEstimator, MultiCameraPoseEstimator
+from pipeline.PoseFilter import PoseFilter
 
 config = Config(LocalConfig(), RemoteConfig())
 file_config_manager = FileConfigManager()
@@ -24,58 +30,212 @@ nt_config_manager = NTConfigManager()
 file_config_manager.update(config)
 nt_config_manager.update(config)
 
-detector = FiducialDetector(config)
-pose_estimator = FiducialPoseEstimator(config)
-annotator = AnnotateFiducials()
-stream = MJPGServer()
+layout = FiducialLayout()
 publisher = NTPublisher(config)
-capture = DefaultCapture(publisher)
+cameras = []
+
+# Only the single camera and pipelined modes use these, multi-camera devices build their own per camera
+detector = None
+pose_estimator = None
+annotator = None
+stream = None
+capture = None
+metrics = None
+
+def setup_single_camera():
+    global detector, pose_estimator, annotator, stream, capture, metrics
+
+    detector = FiducialDetector(config)
+    pose_estimator = FiducialPoseEstimator(config, layout)
+    annotator = AnnotateFiducials()
+    stream = MJPGServer()
+    capture = DefaultCapture(publisher)
+    metrics = Metrics(config.local.metrics)
 
 def main():
 
     publisher.sendMsg(config.local.device_name + " has started")
 
-    stream.start(config)
+    stream.start(config, metrics)
 
-    start_time = time.time()
-    counter = 0
+    camera = Camera(config, capture, detector, pose_estimator, publisher, stream, metrics)
 
     while True:
+        span = metrics.start()
         nt_config_manager.update(config)
+        metrics.record("config", span)
 
-        fpt_start = time.time()
-        counter += 1
-        
-        frame = capture.getFrame(config)
+        camera.process()
 
-        if frame is None: 
-            publisher.sendMsg("Camera not connected")
-            publisher.send(0, 0, None, None, [], None)
-            capture.release()
-            continue
+def main_multi_camera():
+
+    # Cameras share the NetworkTables connection, remote config, dictionaries and fiducial layout, and each has its own
+    # capture, detector, calibration, publisher subtable and stream port. OpenCV releases the GIL while detecting and
+    # solving, so a thread pool spreads the cameras across cores without a process and a copy of everything per camera.
+    for camera_config in file_config_manager.cameraConfigs(config):
+        camera_publisher = NTPublisher(camera_config)
+        camera_stream = MJPGServer()
+        camera_metrics = Metrics(camera_config.local.metrics)
+        camera_stream.start(camera_config, camera_metrics)
+        cameras.append(Camera(camera_config, DefaultCapture(camera_publisher), FiducialDetector(camera_config),
+                              FiducialPoseEstimator(camera_config, layout), camera_publisher, camera_stream, camera_metrics))
+
+    publisher.sendMsg(config.local.device_name + " has started with " + str(len(cameras)) + " cameras")
+
+    multi_camera_pose_estimator = MultiCameraPoseEstimator(layout)
+    start_time = time.time()
+    counter = 0
+    fps = 0
+
+    with ThreadPoolExecutor(max_workers=min(len(cameras), os.cpu_count() or 1)) as executor:
+        while True:
+            spans = [camera.metrics.start() for camera in cameras]
+            nt_config_manager.update(config)
 
-        fiducials, tids, all_corners = detector.detect(frame)
+            # The layout is shared, so rebuild it here rather than from several camera threads at once
+            layout.update(config)
+            for camera, span in zip(cameras, spans):
+                camera.config.version = config.version
+                camera.metrics.record("config", span)
 
-        areas = []
-        if tids is not None and all_corners is not None:
-            frame = cv2.aruco.drawDetectedMarkers(frame, all_corners, tids)
-            tids, areas = detector.orderIDs(all_corners, tids)
+            fpt_start = time.time()
+            for future in [executor.submit(camera.process) for camera in cameras]:
+                future.result()
 
-        tids, primary_pose, reprojection_error = pose_estimator.process(fiducials, config)
+            # Publish one robot pose solved from every camera's tags to /<device_name>/output
+            if config.local.fuse_cameras:
+                counter += 1
+                if (time.time() - start_time) > 1:
+                    fps = counter / (time.time() - start_time)
+                    start_time = time.time()
+                    counter = 0
 
-        if (time.time() - start_time) > 1:
-            fps = counter / (time.time() - start_time)
-            start_time = time.time()
-            counter = 0
-        
-        fpt = time.time() - fpt_start
+                observations = [camera.observation for camera in cameras]
+                tids, robot_pose, reprojection_error, timestamp = multi_camera_pose_estimator.process(observations, config)
+                areas = [area for observation in observations if observation is not None for area in observation.areas]
+                publisher.send(fps, time.time() - fpt_start, tids, robot_pose, areas, reprojection_error, timestamp)
 
-        publisher.send(fps, fpt, tids, primary_pose, areas, reprojection_error)
-        stream.set_frame(frame)
+def main_pipelined():
+
+    publisher.sendMsg(config.local.device_name + " has started in pipelined mode")
+
+    stream.start(config, metrics)
+
+    fps_state = {"start_time": time.time(), "counter": 0, "fps": 0}
+    pose_filter = PoseFilter() if config.local.pose_filter else None
+    exposure_controller = ExposureController(config) if config.local.exposure_control else None
+
+    def capture_stage():
+        loop_start = span = metrics.start()
+        nt_config_manager.update(config)
+        span = metrics.record("config", span)
+
+        fpt_start = time.time()
+        frame_buffer = capture.getFrame(config)
+        metrics.record("capture", span)
+
+        if frame_buffer is None:
+            publisher.sendMsg("Camera not connected")
+            publisher.send(0, 0, None, None, [], None)
+            capture.release()
+            return None
+
+        if config.local.calibrations is not None:
+            message = config.local.calibrations.apply(config, *frame_buffer.image.shape[:2])
+            if message is not None:
+                publisher.sendMsg(message)
+
+        return FrameData(frame=frame_buffer.image, frame_buffer=frame_buffer, fpt_start=fpt_start, loop_start=loop_start)
+
+    def detect_stage(data: FrameData):
+        span = metrics.start()
+        undistorter = config.local.undistorter
+        if undistorter is not None:
+            data.frame = undistorter.undistortFrame(data.frame)
+            span = metrics.record("undistort", span)
+
+        data.fiducials, data.tids, data.all_corners = detector.detect(data.frame)
+        span = metrics.record("detect", span)
+
+        if exposure_controller is not None:
+            controls = exposure_controller.update(data.frame, data.all_corners)
+            if controls is not None:
+                capture.setControls(controls)
+            publisher.sendExposure(exposure_controller.exposure, exposure_controller.gain, exposure_controller.brightness, exposure_controller.detection_rate, exposure_controller.sharpness)
+            span = metrics.record("exposure", span)
+
+        if stream.has_clients():
+            data.frame = data.frame_buffer.color() if undistorter is None else undistorter.undistortFrame(data.frame_buffer.color(), color=True)
+            if data.tids is not None and data.all_corners is not None:
+                data.frame = cv2.aruco.drawDetectedMarkers(data.frame, data.all_corners, data.tids)
+            span = metrics.record("draw", span)
+
+        if undistorter is not None:
+            data.fiducials, data.all_corners = undistorter.undistortCorners(data.fiducials, data.all_corners)
+
+        if data.tids is not None and data.all_corners is not None:
+            data.tids, data.areas, _, _, _ = detector.orderIDs(data.all_corners, data.tids)
+        metrics.record("order", span)
+
+        return data
+
+    def solve_stage(data: FrameData):
+        span = metrics.start()
+        data.tids, data.primary_pose, data.reprojection_error = pose_estimator.process(data.fiducials, config)
+        data.ambiguity = pose_estimator.ambiguity
+        span = metrics.record("solve", span)
+
+        if pose_filter is not None and data.primary_pose is not None:
+            data.primary_pose, data.pose_std = pose_filter.update(data.primary_pose, data.reprojection_error, len(data.tids),
+                                                                  pose_estimator.tag_distance, data.frame_buffer.timestamp)
+            metrics.record("filter", span)
+
+        return data
+
+    def publish_stage(data: FrameData):
+        fps_state["counter"] += 1
+        if (time.time() - fps_state["start_time"]) > 1:
+            fps_state["fps"] = fps_state["counter"] / (time.time() - fps_state["start_time"])
+            fps_state["start_time"] = time.time()
+            fps_state["counter"] = 0
+            publisher.sendDroppedFrames(capture.droppedFrames())
+
+        fpt = time.time() - data.fpt_start
+
+        span = metrics.start()
+        publisher.send(fps_state["fps"], fpt, data.tids, data.primary_pose, data.areas, data.reprojection_error, data.frame_buffer.timestamp, data.pose_std)
+        publisher.sendAmbiguity(data.ambiguity)
+        span = metrics.record("publish", span)
+        stream.set_frame(data.frame, fpt)
+        metrics.record("stream", span)
+        metrics.record("total", data.loop_start)
+
+        if metrics.due():
+            publisher.sendTiming(metrics.summary())
+
+        data.release()
+
+    pipeline = Pipeline(on_drop=lambda data: data.release(),
+                        on_error=lambda name, e: publisher.sendMsg("Error in " + name + " stage: " + repr(e)))
+    pipeline.addStage("capture", capture_stage)
+    pipeline.addStage("detect", detect_stage)
+    pipeline.addStage("solve", solve_stage)
+    pipeline.addStage("publish", publish_stage)
+    pipeline.start().join()
 
 if __name__ == '__main__':
     try: 
-        main()
+        if len(config.local.cameras) > 0:
+            main_multi_camera()
+        elif config.local.pipelined:
+            setup_single_camera()
+            main_pipelined()
+        else:
+            setup_single_camera()
+            main()
     except KeyboardInterrupt:
-        capture.release()
+        if capture is not None:
+            capture.release()
         publisher.close()
+        for camera in cameras:
+            camera.release()
@@ -0,0 +1,230 @@
+"""
+Copyright (c) 2023-2024 Ivan Chen, StuyPulse
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/license/MIT.
+"""
+
+# Replays recorded frames through detection and pose estimation and reports per-stage latency, throughput and memory
+# Runs headless: remote config is served from a local NetworkTables instance instead of a robot
+
+import argparse
+import json
+import os
+import resource
+import time
+
+import ntcore
+import numpy
+from wpimath.geometry import Pose3d, Quaternion, Rotation3d, Translation3d
+
+from config.Config import Config, LocalConfig, RemoteConfig
+from config.ConfigManager import FileConfigManager, NTConfigManager
+from pipeline.Capture import ReplayCapture
+from pipeline.Detector import FiducialDetector
+from pipeline.PoseEstimator import FiducialPoseEstimator
+
+STAGES = ["capture", "undistort", "detect", "order", "solve", "total"]
+
+def loadLayout(path: str):
+    """
+    Reads a layout file as a flat [id, x, y, z, roll, pitch, yaw, ...] list, the same format robot code publishes.
+    Accepts either {"fiducial_layout": [...], "fiducial_size": ...} or a WPILib AprilTag field layout.
+    """
+    with open(path, "r") as file:
+        data = json.load(file)
+
+    if "fiducial_layout" in data:
+        return data["fiducial_layout"], data.get("fiducial_size")
+
+    layout = []
+    for tag in data["tags"]:
+        translation = tag["pose"]["translation"]
+        q = tag["pose"]["rotation"]["quaternion"]
+        rotation = Rotation3d(Quaternion(q["W"], q["X"], q["Y"], q["Z"]))
+        layout += [tag["ID"], translation["x"], translation["y"], translation["z"], rotation.X(), rotation.Y(), rotation.Z()]
+    return layout, None
+
+def publishRemoteConfig(config: Config, args):
+    table = ntcore.NetworkTableInstance.getDefault().getTable(config.local.device_name).getSubTable("config")
+    publishers = []
+
+    if args.layout is not None:
+        layout, fiducial_size = loadLayout(args.layout)
+        publishers.append(table.getDoubleArrayTopic("fiducial_layout").publish())
+        publishers[-1].set(layout)
+        if fiducial_size is not None:
+            publishers.append(table.getDoubleTopic("fiducial_size").publish())
+            publishers[-1].set(fiducial_size)
+
+    publishers.append(table.getDoubleTopic("detection_scale").publish())
+    publishers[-1].set(args.scale)
+
+    return publishers
+
+def loadGroundTruth(path: str) -> dict:
+    """Reads a ground truth file written by synthetic_scene_gen.py as {image file name: camera Pose3d}."""
+    with open(path, "r") as file:
+        data = json.load(file)
+    return {frame["image"]: Pose3d(Translation3d(*frame["pose"][:3]), Rotation3d(*frame["pose"][3:])) for frame in data["frames"]}
+
+def percentiles(values) -> dict:
+    values = numpy.asarray(values)
+    if len(values) == 0:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "mean": 0.0}
+    p50, p95, p99 = numpy.percentile(values, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "mean": float(values.mean())}
+
+def run(args) -> dict:
+    config = Config(LocalConfig(), RemoteConfig())
+    FileConfigManager().update(config)
+    config.local.roi_tracking = args.roi
+    config.local.pose_tracking = args.pose_tracking
+    config.local.capture_format = args.format
+    if args.undistort != config.local.undistort:
+        config.local.undistort = args.undistort
+        FileConfigManager().loadCalibration(config, FileConfigManager.calibration_file_name)
+    undistorter = config.local.undistorter
+
+    ntcore.NetworkTableInstance.getDefault().startLocal()
+    publishers = publishRemoteConfig(config, args)
+    nt_config_manager = NTConfigManager()
+    time.sleep(0.1)
+    nt_config_manager.update(config)
+
+    ground_truth = loadGroundTruth(args.ground_truth) if args.ground_truth is not None else None
+
+    capture = ReplayCapture(args.path, fps=args.fps, loop=args.loop)
+    detector = FiducialDetector(config)
+    pose_estimator = FiducialPoseEstimator(config)
+
+    timings = {stage: [] for stage in STAGES}
+    translation_errors = []
+    rotation_errors = []
+    detected_frames = 0
+    posed_frames = 0
+    frames = 0
+
+    start_time = time.perf_counter()
+    while args.frames <= 0 or frames < args.frames + args.warmup:
+        t0 = time.perf_counter_ns()
+        nt_config_manager.update(config)
+        frame_buffer = capture.getFrame(config)
+        if frame_buffer is None:
+            break
+        if config.local.calibrations is not None:
+            config.local.calibrations.apply(config, *frame_buffer.image.shape[:2])
+            undistorter = config.local.undistorter
+        t1 = time.perf_counter_ns()
+
+        frame = undistorter.undistortFrame(frame_buffer.image) if undistorter is not None else frame_buffer.image
+        t2 = time.perf_counter_ns()
+
+        fiducials, tids, all_corners = detector.detect(frame)
+        if undistorter is not None:
+            fiducials, all_corners = undistorter.undistortCorners(fiducials, all_corners)
+        t3 = time.perf_counter_ns()
+
+        if tids is not None and all_corners is not None:
+            detector.orderIDs(all_corners, tids)
+        t4 = time.perf_counter_ns()
+
+        tids, primary_pose, reprojection_error = pose_estimator.process(fiducials, config)
+        t5 = time.perf_counter_ns()
+
+        frame_buffer.release()
+        frames += 1
+
+        if frames == args.warmup:
+            start_time = time.perf_counter()
+        if frames <= args.warmup:
+            continue
+
+        for stage, elapsed in zip(STAGES, [t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4, t5 - t0]):
+            timings[stage].append(elapsed / 1e6)
+        detected_frames += fiducials is not None
+        posed_frames += primary_pose is not None
+
+        truth = ground_truth.get(os.path.basename(capture.current)) if ground_truth is not None and capture.current is not None else None
+        if truth is not None and primary_pose is not None:
+            error = primary_pose.relativeTo(truth)
+            translation_errors.append(error.translation().norm())
+            angle = numpy.degrees(error.rotation().angle) % 360
+            rotation_errors.append(min(angle, 360 - angle))
+
+    elapsed = time.perf_counter() - start_time
+    measured = max(frames - args.warmup, 0)
+
+    for publisher in publishers:
+        publisher.close()
+    ntcore.NetworkTableInstance.getDefault().removeListener(nt_config_manager.listener)
+    ntcore.NetworkTableInstance.getDefault().stopLocal()
+    capture.release()
+
+    results = {
+        "path": args.path,
+        "frames": measured,
+        "detected_frames": detected_frames,
+        "posed_frames": posed_frames,
+        "throughput_fps": measured / elapsed if elapsed > 0 else 0.0,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "latency_ms": {stage: percentiles(values) for stage, values in timings.items()},
+    }
+
+    if ground_truth is not None:
+        results["translation_error_m"] = percentiles(translation_errors)
+        results["rotation_error_deg"] = percentiles(rotation_errors)
+
+    return results
+
+def report(results: dict) -> None:
+    print("""
+#########
+Benchmark
+#########
+""")
+    print("Source: " + results["path"])
+    print("Frames: " + str(results["frames"]) + " (" + str(results["detected_frames"]) + " with tags, " + str(results["posed_frames"]) + " with a pose)")
+    print("Throughput: " + str(round(results["throughput_fps"], 1)) + " fps")
+    print("Peak RSS: " + str(round(results["peak_rss_mb"], 1)) + " MB\n")
+
+    print("{:<10}{:>10}{:>10}{:>10}{:>10}".format("stage", "mean", "p50", "p95", "p99"))
+    for stage, stats in results["latency_ms"].items():
+        print("{:<10}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}".format(stage, stats["mean"], stats["p50"], stats["p95"], stats["p99"]))
+    print("(milliseconds)")
+
+    if "translation_error_m" in results:
+        print("\n{:<14}{:>10}{:>10}{:>10}{:>10}".format("pose error", "mean", "p50", "p95", "p99"))
+        for name, key in [("translation m", "translation_error_m"), ("rotation deg", "rotation_error_deg")]:
+            stats = results[key]
+            print("{:<14}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}".format(name, stats["mean"], stats["p50"], stats["p95"], stats["p99"]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the detection and pose estimation pipeline on recorded frames.")
+    parser.add_argument("path", help="folder of images (e.g. ../captures) or a video file")
+    parser.add_argument("--layout", help="fiducial layout JSON file, defaults to the ground truth file's layout")
+    parser.add_argument("--ground-truth", help="ground truth file from synthetic_scene_gen.py, defaults to ground_truth.json in the image folder")
+    parser.add_argument("--fps", type=float, default=0, help="replay rate, 0 replays as fast as possible")
+    parser.add_argument("--frames", type=int, default=0, help="number of frames to measure, 0 measures the whole recording")
+    parser.add_argument("--warmup", type=int, default=5, help="number of frames to run before measuring")
+    parser.add_argument("--loop", action="store_true", help="loop the recording until --frames have been measured")
+    parser.add_argument("--scale", type=float, default=RemoteConfig.detection_scale, help="detection_scale to benchmark")
+    parser.add_argument("--roi", action="store_true", help="enable ROI-tracked detection")
+    parser.add_argument("--pose-tracking", action="store_true", help="enable warm-started pose refinement")
+    parser.add_argument("--undistort", choices=["off", "frame", "points"], default="off", help="undistort mode to benchmark")
+    parser.add_argument("--format", choices=["bgr", "gray"], default="bgr", help="capture format to replay as")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.ground_truth is None and os.path.isfile(os.path.join(args.path, "ground_truth.json")):
+        args.ground_truth = os.path.join(args.path, "ground_truth.json")
+    if args.layout is None:
+        args.layout = args.ground_truth
+
+    results = run(args)
+    report(results)
+
+    if args.json is not None:
+        with open(args.json, "w") as file:
+            file.write(json.dumps(results, indent=4))
@@ -0,0 +1,89 @@
+"""
+Copyright (c) 2023-2024 Ivan Chen, StuyPulse
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/license/MIT.
+"""
+
+import os
+import numpy
+
+from config.Config import Config
+from pipeline.Undistorter import Undistorter
+
+class CalibrationStore:
+    """
+    Every calibration in a calibration file, keyed by resolution. apply picks the one matching the frames the camera
+    actually delivers, or scales one with the same aspect ratio, whenever the resolution changes.
+    """
+
+    # Aspect ratios closer than this are treated as the same sensor area at a different scale
+    aspect_tolerance = 0.01
+
+    def __init__(self, file_path: str, calibrations: list):
+        self.file_path = file_path
+        self.calibrations = calibrations
+        # [height, width] the config's camera matrix currently describes
+        self.resolution = None
+
+    @classmethod
+    def entries(cls, data: dict) -> list:
+        """Reads a calibration file, either a single calibration or {"calibrations": [...]} with one per resolution."""
+        return data["calibrations"] if "calibrations" in data else [data]
+
+    def find(self, height: int, width: int):
+        """Returns the camera matrix and distortion coefficients for a resolution, and the [height, width] they were scaled from, if any."""
+        sized = [c for c in self.calibrations if c.get("resolution") is not None]
+        if len(sized) == 0:
+            # Older calibration files don't record a resolution, assume they match as before
+            calibration = self.calibrations[0]
+            return numpy.asarray(calibration["camera_matrix"]), numpy.asarray(calibration["distortion_coefficient"]), None
+
+        for calibration in sized:
+            if list(calibration["resolution"]) == [height, width]:
+                return numpy.asarray(calibration["camera_matrix"]), numpy.asarray(calibration["distortion_coefficient"]), None
+
+        # Prefer scaling a larger calibration down, its corners were located more precisely
+        aspect = width / height
+        same_aspect = [c for c in sized if abs(c["resolution"][1] / c["resolution"][0] - aspect) < self.aspect_tolerance * aspect]
+        candidates = same_aspect if len(same_aspect) > 0 else sized
+        calibration = min(candidates, key=lambda c: (c["resolution"][1] < width, abs(c["resolution"][1] - width)))
+
+        scale_x = width / calibration["resolution"][1]
+        scale_y = height / calibration["resolution"][0]
+        camera_matrix = numpy.asarray(calibration["camera_matrix"], dtype=numpy.float64).copy()
+        # Pixel centers sit at half pixel offsets, so scale about the image corner rather than pixel 0
+        camera_matrix[0, 0] *= scale_x
+        camera_matrix[0, 2] = (camera_matrix[0, 2] + 0.5) * scale_x - 0.5
+        camera_matrix[1, 1] *= scale_y
+        camera_matrix[1, 2] = (camera_matrix[1, 2] + 0.5) * scale_y - 0.5
+
+        # Distortion coefficients work on normalized coordinates and don't change with scale
+        return camera_matrix, numpy.asarray(calibration["distortion_coefficient"]), list(calibration["resolution"])
+
+    def apply(self, config: Config, height: int, width: int):
+        """Sets the config's camera matrix, distortion coefficients and undistorter for a resolution. Returns a message if they changed."""
+        if self.resolution == [height, width]:
+            return None
+
+        camera_matrix, distortion_coefficient, source = self.find(height, width)
+        config.local.camera_matrix = camera_matrix
+        config.local.distortion_coefficient = distortion_coefficient
+
+        # Everything downstream of the undistorter sees the rectified camera matrix and no distortion
+        config.local.undistorter = None
+        if config.local.undistort in ["frame", "points"]:
+            cache_file = os.path.splitext(self.file_path)[0] + "_undistort_" + str(width) + "x" + str(height) + ".npz"
+            config.local.undistorter = Undistorter(camera_matrix, distortion_coefficient, [height, width], config.local.undistort, cache_file)
+            config.local.camera_matrix = config.local.undistorter.camera_matrix
+            config.local.distortion_coefficient = config.local.undistorter.distortion_coefficient
+
+        self.resolution = [height, width]
+
+        if source is None:
+            return "Using calibration for " + str(width) + "x" + str(height)
+        message = "No calibration for " + str(width) + "x" + str(height) + ", scaled the " + str(source[1]) + "x" + str(source[0]) + " calibration"
+        if abs(source[1] / source[0] - width / height) >= self.aspect_tolerance * width / height:
+            message += " to a different aspect ratio, calibrate this resolution for accurate poses"
+        return message
@@ -16,6 +16,30 @@ class LocalConfig:
     server_ip: str = ""
     team_number: int = 0
     stream_port: int = 5802
+    # Set per camera when config.json lists several cameras, see FileConfigManager.cameraConfigs
+    camera_name: str = ""
+    camera_id: int = -1
+    cameras: list = field(default_factory=list)
+    # [x, y, z, roll, pitch, yaw]: [m, m, m, rad, rad, rad] of the camera relative to the robot
+    robot_to_camera: list = None
+    fuse_cameras: bool = False
+    pipelined: bool = False
+    capture_format: str = "bgr"
+    low_latency: bool = False
+    roi_tracking: bool = False
+    roi_full_search_interval: int = 10
+    roi_padding: float = 0.5
+    pose_tracking: bool = False
+    # Single-tag solutions whose best to second best reprojection error ratio is above this are checked against recent poses
+    ambiguity_threshold: float = 1.0
+    use_gyro: bool = False
+    pose_filter: bool = False
+    # "off", "frame" to remap whole frames before detection, or "points" to undistort only the detected corners
+    undistort: str = "off"
+    exposure_control: bool = False
+    # Longest exposure the exposure controller may use, in the camera's exposure units, to limit motion blur
+    max_exposure: int = 50
+    metrics: bool = False
     detection_dictionary: any = None
     calibration_dictionary: any = None
     aruco_parameters: any = None
@@ -23,6 +47,9 @@ class LocalConfig:
 
     camera_matrix: numpy.typing.NDArray[numpy.float64] = None
     distortion_coefficient: numpy.typing.NDArray[numpy.float64] = None
+    # Set by FileConfigManager.loadCalibration, and again by the camera whenever the frame resolution changes
+    calibrations: any = None
+    undistorter: any = None
 
 @dataclass
 class RemoteConfig:
@@ -33,6 +60,13 @@ class RemoteConfig:
     camera_exposure: int = 50
     camera_gain: int = 0
     camera_brightness: int = 0
+    # Fraction of the full resolution to search for markers at, e.g. 0.5 or 0.25
+    detection_scale: float = 1.0
+    stream_max_width: int = 0
+    stream_quality: int = 75
+    stream_max_fps: float = 0
+    stream_auto: int = 0
+    stream_fpt_budget: float = 0.02
     fiducial_size: float = 0.15
     # [id, x, y, z, roll, pitch, yaw]: [_, m, m, m, rad, rad, rad]
     fiducial_layout: list = field(default_factory=list)
@@ -40,4 +74,6 @@ class RemoteConfig:
 @dataclass
 class Config:
     local: LocalConfig
-    remote: RemoteConfig
\ No newline at end of file
+    remote: RemoteConfig
+    # Incremented whenever any config value changes, so consumers can cheaply check for changes
+    version: int = 0
\ No newline at end of file
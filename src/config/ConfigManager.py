@@ -9,11 +9,13 @@ https://opensource.org/license/MIT.
 import os
 import json
 import cv2
-import numpy
 import sys
-from ntcore import IntegerSubscriber, DoubleSubscriber, DoubleArraySubscriber, NetworkTableInstance
+import dataclasses
+from threading import Event
+from ntcore import IntegerSubscriber, DoubleSubscriber, DoubleArraySubscriber, EventFlags, NetworkTableInstance
 
 from config.Config import Config, RemoteConfig
+from config.Calibration import CalibrationStore
 
 FAMILY_DICTIONARY = {
     "4X4_50": cv2.aruco.DICT_4X4_50,
@@ -59,6 +61,22 @@ class FileConfigManager:
             config.local.server_ip = f"10.{s[:2].lstrip('0')}.{s[2:].lstrip('0')}.2"
         
         config.local.stream_port = config_data["stream_port"]
+        config.local.cameras = config_data.get("cameras", [])
+        config.local.fuse_cameras = config_data.get("fuse_cameras", False)
+        config.local.pipelined = config_data.get("pipelined", False)
+        config.local.capture_format = config_data.get("capture_format", "bgr")
+        config.local.low_latency = config_data.get("low_latency", False)
+        config.local.roi_tracking = config_data.get("roi_tracking", False)
+        config.local.roi_full_search_interval = config_data.get("roi_full_search_interval", 10)
+        config.local.roi_padding = config_data.get("roi_padding", 0.5)
+        config.local.pose_tracking = config_data.get("pose_tracking", False)
+        config.local.ambiguity_threshold = config_data.get("ambiguity_threshold", 1.0)
+        config.local.use_gyro = config_data.get("use_gyro", False)
+        config.local.pose_filter = config_data.get("pose_filter", False)
+        config.local.undistort = config_data.get("undistort", "off")
+        config.local.exposure_control = config_data.get("exposure_control", False)
+        config.local.max_exposure = config_data.get("max_exposure", 50)
+        config.local.metrics = config_data.get("metrics", False)
 
         config.local.detection_dictionary = cv2.aruco.getPredefinedDictionary(FAMILY_DICTIONARY[config_data["detection_dictionary"]])
         config.local.calibration_dictionary = cv2.aruco.getPredefinedDictionary(FAMILY_DICTIONARY[config_data["calibration_dictionary"]])
@@ -94,19 +112,11 @@ class FileConfigManager:
         cbp = config_data["charuco_board"]
         config.local.charuco_board = cv2.aruco.CharucoBoard((int(cbp[0]), int(cbp[1])), cbp[2], cbp[3], config.local.calibration_dictionary)
 
-        if not os.path.isfile(os.getcwd() + "/config/data/" + self.calibration_file_name):
-            print("Calibration file not found, please run calibration first.")
-            exit(1)
-        
-        with open(os.getcwd() + "/config/data/" + self.calibration_file_name, "r") as file:
-            calibration = json.load(file)
-                
-        camera_matrix = numpy.asarray(calibration["camera_matrix"])
-        distortion_coefficient = numpy.asarray(calibration["distortion_coefficient"])
+        # With several cameras each one loads its own calibration in cameraConfigs
+        if len(config.local.cameras) == 0:
+            self.loadCalibration(config, self.calibration_file_name)
 
-        if type(camera_matrix) == numpy.ndarray and type(distortion_coefficient) == numpy.ndarray:
-            config.local.camera_matrix = camera_matrix
-            config.local.distortion_coefficient = distortion_coefficient
+        config.version += 1
 
         print("""
 #############
@@ -116,11 +126,51 @@ Configuration
         print("Device Name: " + config.local.device_name)
         print("Server IP: " + config.local.server_ip)
         print("Stream Port: " + str(config.local.stream_port))
+        print("Pipelined: " + str(config.local.pipelined))
+        print("Capture Format: " + str(config.local.capture_format))
+        print("Low Latency: " + str(config.local.low_latency))
+        print("ROI Tracking: " + str(config.local.roi_tracking))
+        print("Pose Tracking: " + str(config.local.pose_tracking))
+        print("Ambiguity Threshold: " + str(config.local.ambiguity_threshold))
+        print("Use Gyro: " + str(config.local.use_gyro))
+        print("Pose Filter: " + str(config.local.pose_filter))
+        print("Undistort: " + str(config.local.undistort))
+        print("Exposure Control: " + str(config.local.exposure_control) + (" (max exposure " + str(config.local.max_exposure) + ")" if config.local.exposure_control else ""))
+        print("Metrics: " + str(config.local.metrics))
+        print("Cameras: " + (", ".join(str(camera["name"]) for camera in config.local.cameras) if len(config.local.cameras) > 0 else "1"))
         print("Detection Dictionary: " + str(config_data["detection_dictionary"]))
         print("Calibration Dictionary: " + str(config_data["calibration_dictionary"]))
         print("Camera Matrix: \n" + str(config.local.camera_matrix))
         print("Distortion Coefficients: \n" + str(config.local.distortion_coefficient) + "\n")
 
+    def loadCalibration(self, config: Config, file_name: str) -> None:
+        if not os.path.isfile(os.getcwd() + "/config/data/" + file_name):
+            print("Calibration file " + file_name + " not found, please run calibration first.")
+            exit(1)
+        
+        with open(os.getcwd() + "/config/data/" + file_name, "r") as file:
+            calibrations = CalibrationStore.entries(json.load(file))
+
+        # Start with the first calibration as is, the camera re-applies the store once it knows the actual frame size
+        config.local.calibrations = CalibrationStore(os.getcwd() + "/config/data/" + file_name, calibrations)
+        resolution = calibrations[0].get("resolution", [config.remote.camera_resolution_height, config.remote.camera_resolution_width])
+        config.local.calibrations.apply(config, resolution[0], resolution[1])
+
+    def cameraConfigs(self, config: Config) -> list:
+        """
+        One Config per entry of the "cameras" list in config.json. Each gets its own copy of the local config
+        with the camera's name, id, calibration and stream port, and shares the remote config and everything
+        else loaded once, like the dictionaries and detector parameters.
+        """
+        configs = []
+        for i, camera in enumerate(config.local.cameras):
+            local = dataclasses.replace(config.local, camera_name=camera["name"], camera_id=camera.get("id", i),
+                                        robot_to_camera=camera.get("robot_to_camera"), stream_port=config.local.stream_port + i)
+            camera_config = Config(local, config.remote, config.version)
+            self.loadCalibration(camera_config, camera.get("calibration", str(camera["name"]) + "_" + self.calibration_file_name))
+            configs.append(camera_config)
+        return configs
+
 class NTConfigManager:
     init_complete: bool = False
 
@@ -131,11 +181,21 @@ class NTConfigManager:
     camera_exposure_sub: IntegerSubscriber
     camera_gain_sub: DoubleSubscriber
     camera_brightness_sub: DoubleSubscriber
+    detection_scale_sub: DoubleSubscriber
+    stream_max_width_sub: IntegerSubscriber
+    stream_quality_sub: IntegerSubscriber
+    stream_max_fps_sub: DoubleSubscriber
+    stream_auto_sub: IntegerSubscriber
+    stream_fpt_budget_sub: DoubleSubscriber
     fiducial_size_sub: DoubleSubscriber
     fiducial_layout_sub: DoubleArraySubscriber
+    network_layout: list = None
+    listener: int = None
 
     def __init__(self):
-        pass
+        # Set from the NetworkTables listener thread whenever any config topic changes
+        self.changed = Event()
+        self.changed.set()
 
     def update(self, config: Config) -> None:
         if not self.init_complete:
@@ -149,10 +209,24 @@ class NTConfigManager:
             self.camera_exposure_sub = table.getIntegerTopic("camera_exposure").subscribe(RemoteConfig.camera_exposure)
             self.camera_gain_sub = table.getDoubleTopic("camera_gain").subscribe(RemoteConfig.camera_gain)
             self.camera_brightness_sub = table.getDoubleTopic("camera_brightness").subscribe(RemoteConfig.camera_brightness)
+            self.detection_scale_sub = table.getDoubleTopic("detection_scale").subscribe(RemoteConfig.detection_scale)
+            self.stream_max_width_sub = table.getIntegerTopic("stream_max_width").subscribe(RemoteConfig.stream_max_width)
+            self.stream_quality_sub = table.getIntegerTopic("stream_quality").subscribe(RemoteConfig.stream_quality)
+            self.stream_max_fps_sub = table.getDoubleTopic("stream_max_fps").subscribe(RemoteConfig.stream_max_fps)
+            self.stream_auto_sub = table.getIntegerTopic("stream_auto").subscribe(RemoteConfig.stream_auto)
+            self.stream_fpt_budget_sub = table.getDoubleTopic("stream_fpt_budget").subscribe(RemoteConfig.stream_fpt_budget)
             self.fiducial_size_sub = table.getDoubleTopic("fiducial_size").subscribe(RemoteConfig.fiducial_size)
             self.fiducial_layout_sub = table.getDoubleArrayTopic("fiducial_layout").subscribe([])
+            self.listener = NetworkTableInstance.getDefault().addListener(
+                [table.getPath() + "/"], EventFlags.kValueAll | EventFlags.kImmediate, lambda event: self.changed.set())
             self.init_complete = True
 
+        if not self.changed.is_set():
+            return
+        self.changed.clear()
+
+        previous = dataclasses.replace(config.remote)
+
         config.remote.camera_id = self.camera_id_sub.get()
         config.remote.camera_resolution_width = self.camera_resolution_width_sub.get()
         config.remote.camera_resolution_height = self.camera_resolution_height_sub.get()
@@ -160,19 +234,32 @@ class NTConfigManager:
         config.remote.camera_exposure = self.camera_exposure_sub.get()
         config.remote.camera_gain = self.camera_gain_sub.get()
         config.remote.camera_brightness = self.camera_brightness_sub.get()
+        config.remote.detection_scale = self.detection_scale_sub.get()
+        config.remote.stream_max_width = self.stream_max_width_sub.get()
+        config.remote.stream_quality = self.stream_quality_sub.get()
+        config.remote.stream_max_fps = self.stream_max_fps_sub.get()
+        config.remote.stream_auto = self.stream_auto_sub.get()
+        config.remote.stream_fpt_budget = self.stream_fpt_budget_sub.get()
         config.remote.fiducial_size = self.fiducial_size_sub.get()
         networkLayout = self.fiducial_layout_sub.get()
-        
-        layout = {}
-
-        for i in range(int(len(networkLayout) / 7)):
-            layout[int(networkLayout[i * 7 + 0])] = [
-                networkLayout[i * 7 + 1], 
-                networkLayout[i * 7 + 2],
-                networkLayout[i * 7 + 3],
-                networkLayout[i * 7 + 4],
-                networkLayout[i * 7 + 5],
-                networkLayout[i * 7 + 6]
-            ]
-
-        config.remote.fiducial_layout = layout
+
+        # Only rebuild the layout when it changes, so the layout object can be compared by identity
+        if networkLayout != self.network_layout:
+            self.network_layout = networkLayout
+
+            layout = {}
+
+            for i in range(int(len(networkLayout) / 7)):
+                layout[int(networkLayout[i * 7 + 0])] = [
+                    networkLayout[i * 7 + 1], 
+                    networkLayout[i * 7 + 2],
+                    networkLayout[i * 7 + 3],
+                    networkLayout[i * 7 + 4],
+                    networkLayout[i * 7 + 5],
+                    networkLayout[i * 7 + 6]
+                ]
+
+            config.remote.fiducial_layout = layout
+
+        if config.remote != previous:
+            config.version += 1
@@ -0,0 +1,88 @@
+"""
+Copyright (c) 2023-2024 Ivan Chen, StuyPulse
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/license/MIT.
+"""
+
+import time
+from threading import Lock
+
+import numpy
+
+class StageHistogram:
+    """Rolling window of the most recent durations of one stage, plus lifetime totals for Prometheus."""
+
+    def __init__(self, window: int):
+        self.lock = Lock()
+        self.samples = numpy.zeros(window, numpy.float64)
+        self.index = 0
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, seconds: float) -> None:
+        with self.lock:
+            self.samples[self.index % len(self.samples)] = seconds
+            self.index += 1
+            self.count += 1
+            self.sum += seconds
+
+    def quantiles(self, qs) -> list:
+        with self.lock:
+            window = self.samples[:min(self.index, len(self.samples))].copy()
+        if len(window) == 0:
+            return [0.0 for _ in qs]
+        return numpy.percentile(window, [q * 100 for q in qs]).tolist()
+
+class Metrics:
+    """
+    Records hot path stage durations with perf_counter_ns. Every call returns immediately
+    when disabled, so the timing calls can stay in the loop unconditionally.
+    """
+
+    QUANTILES = [0.5, 0.99]
+
+    def __init__(self, enabled: bool = False, window: int = 256, publish_period: float = 1.0):
+        self.enabled = enabled
+        self.window = window
+        self.publish_period = publish_period
+        self.stages = {}
+        self.last_publish = 0.0
+
+    def start(self) -> int:
+        return time.perf_counter_ns() if self.enabled else 0
+
+    def record(self, stage: str, start: int) -> int:
+        """Adds the time since start to the stage and returns the current time as the start of the next span."""
+        if not self.enabled:
+            return 0
+        now = time.perf_counter_ns()
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages.setdefault(stage, StageHistogram(self.window))
+        histogram.add((now - start) / 1e9)
+        return now
+
+    def due(self) -> bool:
+        """Whether the rolling quantiles should be published again, at most once per publish_period."""
+        if not self.enabled or time.monotonic() - self.last_publish < self.publish_period:
+            return False
+        self.last_publish = time.monotonic()
+        return True
+
+    def summary(self) -> dict:
+        """{stage: [p50, p99]} in seconds over the rolling window."""
+        return {stage: histogram.quantiles(self.QUANTILES) for stage, histogram in list(self.stages.items())}
+
+    def prometheus(self) -> str:
+        lines = [
+            "# HELP theia_stage_seconds Duration of each processing stage per frame.",
+            "# TYPE theia_stage_seconds summary"
+        ]
+        for stage, histogram in list(self.stages.items()):
+            for q, value in zip(self.QUANTILES, histogram.quantiles(self.QUANTILES)):
+                lines.append('theia_stage_seconds{stage="%s",quantile="%s"} %.9f' % (stage, q, value))
+            lines.append('theia_stage_seconds_sum{stage="%s"} %.9f' % (stage, histogram.sum))
+            lines.append('theia_stage_seconds_count{stage="%s"} %d' % (stage, histogram.count))
+        return "\n".join(lines) + "\n"
@@ -6,6 +6,7 @@ license that can be found in the LICENSE file or at
 https://opensource.org/license/MIT.
 """
 
+import time
 import ntcore
 from typing import Union
 import numpy.typing
@@ -42,67 +43,151 @@ class NTPublisher:
 
     fps_pub: ntcore.FloatPublisher
     latency_pub: ntcore.DoublePublisher
+    capture_latency_pub: ntcore.DoublePublisher
     tvecs_pub: ntcore.DoubleArrayPublisher
     rvecs_pub: ntcore.DoubleArrayPublisher
     tids_pub: ntcore.IntegerArrayPublisher
     areas_pub: ntcore.DoubleArrayPublisher
     reprojection_error_pub: ntcore.DoublePublisher
+    pose_std_pub: ntcore.DoubleArrayPublisher
+    ambiguity_pub: ntcore.DoublePublisher
 
     msg_pub: ntcore.StringPublisher
     update_counter_pub: ntcore.IntegerPublisher
+    dropped_frames_pub: ntcore.IntegerPublisher
+    exposure_pub: ntcore.IntegerPublisher
+    gain_pub: ntcore.IntegerPublisher
+    brightness_pub: ntcore.DoublePublisher
+    detection_rate_pub: ntcore.DoublePublisher
+    sharpness_pub: ntcore.DoublePublisher
     counter: int
 
+    # Every camera's publisher shares the one NetworkTables client
+    client_started: bool = False
+
     def __init__(self, config: Config):
 
         instance = ntcore.NetworkTableInstance.getDefault()
-        instance.setServerTeam(config.local.team_number)
-        instance.setServer(config.local.server_ip, ntcore.NetworkTableInstance.kDefaultPort4)
-        instance.startClient4(config.local.device_name)
-        table = instance.getTable("/" + config.local.device_name + "/output")
+        if not NTPublisher.client_started:
+            instance.setServerTeam(config.local.team_number)
+            instance.setServer(config.local.server_ip, ntcore.NetworkTableInstance.kDefaultPort4)
+            instance.startClient4(config.local.device_name)
+            NTPublisher.client_started = True
+
+        # Cameras of a multi-camera device publish to their own subtable, /<device_name>/<camera_name>/output
+        if config.local.camera_name != "":
+            table = instance.getTable("/" + config.local.device_name + "/" + config.local.camera_name + "/output")
+        else:
+            table = instance.getTable("/" + config.local.device_name + "/output")
+        self.timing_table = table.getSubTable("timing")
         logging.basicConfig(level=logging.DEBUG)
 
         self.fps_pub = table.getFloatTopic("fps").publish()
         self.fps_pub.setDefault(0)
         self.latency_pub = table.getDoubleTopic("latency").publish(ntcore.PubSubOptions(keepDuplicates=True, periodic=0.02))
         self.latency_pub.setDefault(0)
+        self.capture_latency_pub = table.getDoubleTopic("capture_latency").publish(ntcore.PubSubOptions(keepDuplicates=True, periodic=0.02))
+        self.capture_latency_pub.setDefault(0)
         self.tids_pub = table.getIntegerArrayTopic("tids").publish(ntcore.PubSubOptions(keepDuplicates=True, periodic=0.02))
         self.tids_pub.setDefault([])
         self.pose_sub = table.getDoubleArrayTopic("pose").publish(ntcore.PubSubOptions(keepDuplicates=True, periodic=0.02))
         self.pose_sub.setDefault([])
+        self.pose_std_pub = table.getDoubleArrayTopic("pose_std").publish(ntcore.PubSubOptions(keepDuplicates=True, periodic=0.02))
+        self.pose_std_pub.setDefault([])
         self.areas_pub = table.getDoubleArrayTopic("areas").publish(ntcore.PubSubOptions(keepDuplicates=True, periodic=0.02))
         self.areas_pub.setDefault([])
         self.reprojection_error_pub = table.getDoubleTopic("reprojection_error").publish(ntcore.PubSubOptions(keepDuplicates=True, periodic=0.02))
         self.reprojection_error_pub.setDefault(0)
+        self.ambiguity_pub = table.getDoubleTopic("ambiguity").publish(ntcore.PubSubOptions(keepDuplicates=True, periodic=0.02))
+        self.ambiguity_pub.setDefault(0)
         self.msg_pub = table.getStringTopic("_msg").publish()
         self.update_counter_pub = table.getIntegerTopic("update_counter").publish(ntcore.PubSubOptions(keepDuplicates=True, periodic=0.02))
+        self.dropped_frames_pub = table.getIntegerTopic("dropped_frames").publish()
+        self.dropped_frames_pub.setDefault(0)
+
+        exposure_table = table.getSubTable("exposure")
+        self.exposure_pub = exposure_table.getIntegerTopic("exposure").publish()
+        self.gain_pub = exposure_table.getIntegerTopic("gain").publish()
+        self.brightness_pub = exposure_table.getDoubleTopic("brightness").publish()
+        self.detection_rate_pub = exposure_table.getDoubleTopic("detection_rate").publish()
+        self.sharpness_pub = exposure_table.getDoubleTopic("sharpness").publish()
         
         self.counter = 0
+        # stage -> (p50, p99) publishers, created as stages first report
+        self.timing_pubs = {}
 
-    def send(self, fps: Union[float, None], latency: Union[float, None], tids, primary_pose, areas, reprojection_error):
+    def send(self, fps: Union[float, None], latency: Union[float, None], tids, primary_pose, areas, reprojection_error, capture_timestamp: Union[float, None] = None, pose_std: Union[list, None] = None):
+        """
+        capture_timestamp is the frame's time.monotonic() capture time. Values are stamped with it, converted to
+        NetworkTables time, so robot code can fuse the pose at the moment the image was taken rather than when it arrived.
+        pose_std is the [x, y, z, roll, pitch, yaw] standard deviation of the pose when it has been filtered.
+        """
 
         if fps is not None:
             self.fps_pub.set(fps)
 
         if latency is not None and tids is not None and primary_pose is not None and len(areas) > 0 and reprojection_error is not None:
-            self.latency_pub.set(latency * 1000, ntcore._now())
-            self.tids_pub.set(tids, ntcore._now())
-            self.pose_sub.set(poseToArray(primary_pose), ntcore._now())
-            self.areas_pub.set(areas, ntcore._now())
-            self.update_counter_pub.set(self.counter, ntcore._now())
-            self.reprojection_error_pub.set(reprojection_error, ntcore._now())
+            now = ntcore._now()
+            capture_latency = max(time.monotonic() - capture_timestamp, 0) if capture_timestamp is not None else latency
+            timestamp = now - int(capture_latency * 1e6)
+
+            self.latency_pub.set(latency * 1000, timestamp)
+            self.capture_latency_pub.set(capture_latency * 1000, timestamp)
+            self.tids_pub.set(tids, timestamp)
+            self.pose_sub.set(poseToArray(primary_pose), timestamp)
+            self.pose_std_pub.set(pose_std if pose_std is not None else [], timestamp)
+            self.areas_pub.set(areas, timestamp)
+            self.update_counter_pub.set(self.counter, timestamp)
+            self.reprojection_error_pub.set(reprojection_error, timestamp)
             self.counter += 1
         else:
             self.tids_pub.set([])
             self.pose_sub.set([])
+            self.pose_std_pub.set([])
             self.areas_pub.set([])
             self.reprojection_error_pub.set(0)
 
+    def sendTiming(self, summary: dict):
+        """Publishes each stage's rolling p50 and p99 in milliseconds under timing/<stage>."""
+        for stage, quantiles in summary.items():
+            if stage not in self.timing_pubs:
+                stage_table = self.timing_table.getSubTable(stage)
+                self.timing_pubs[stage] = (stage_table.getDoubleTopic("p50").publish(), stage_table.getDoubleTopic("p99").publish())
+            for pub, value in zip(self.timing_pubs[stage], quantiles):
+                pub.set(value * 1000)
+
+    def sendAmbiguity(self, ambiguity: float):
+        self.ambiguity_pub.set(ambiguity)
+
+    def sendDroppedFrames(self, dropped: int):
+        self.dropped_frames_pub.set(dropped)
+
+    def sendExposure(self, exposure: int, gain: int, brightness: float, detection_rate: float, sharpness: float):
+        """Publishes the exposure controller's state under exposure/."""
+        self.exposure_pub.set(exposure)
+        self.gain_pub.set(gain)
+        self.brightness_pub.set(brightness)
+        self.detection_rate_pub.set(detection_rate)
+        self.sharpness_pub.set(sharpness)
+
     def sendMsg(self, msg: str):
         self.msg_pub.set(msg)
             
     def close(self):
         self.fps_pub.close()
+        self.capture_latency_pub.close()
         self.tids_pub.close()
         self.pose_sub.close()
+        self.pose_std_pub.close()
         self.msg_pub.close()
         self.update_counter_pub.close()
+        self.dropped_frames_pub.close()
+        self.exposure_pub.close()
+        self.gain_pub.close()
+        self.brightness_pub.close()
+        self.detection_rate_pub.close()
+        self.sharpness_pub.close()
+        self.ambiguity_pub.close()
+        for pubs in self.timing_pubs.values():
+            for pub in pubs:
+                pub.close()
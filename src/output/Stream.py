@@ -9,12 +9,13 @@ https://opensource.org/license/MIT.
 import socketserver
 import threading
 import time
+from collections import Counter
 from datetime import datetime
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from io import BytesIO
+from urllib.parse import urlparse, parse_qs
 
 import cv2
-from PIL import Image
+import numpy
 
 from config.Config import Config
 
@@ -29,8 +30,88 @@ class StreamServer:
         raise NotImplementedError
 
 class MJPGServer(StreamServer):
-    _frame: cv2.Mat
-    _has_frame: bool = False
+    _config: Config = None
+    _frame: cv2.Mat = None
+    _encoding: cv2.Mat = None
+    _sequence: int = 0
+    _clients: int = 0
+    _load_factor: float = 1.0
+    _fpt_average: float = 0.0
+    _metrics = None
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        # (width, quality) -> number of clients currently waiting for a frame with those settings
+        self._waiting = Counter()
+        # (width, quality) -> (sequence, jpeg bytes) of the newest frame encoded with those settings
+        self._jpegs = {}
+        # The stream keeps its own copies so callers can reuse or draw on their frames after set_frame
+        self._buffers = []
+
+    def _encode(self) -> None:
+        """Encodes each new frame once per requested setting and shares the result with every waiting client."""
+        while True:
+            with self._cond:
+                while True:
+                    profiles = [profile for profile, count in self._waiting.items()
+                                if count > 0 and self._jpegs.get(profile, (0, None))[0] < self._sequence]
+                    if self._frame is not None and len(profiles) > 0:
+                        break
+                    self._cond.wait()
+                frame = self._frame
+                sequence = self._sequence
+                self._encoding = frame
+
+            resized = {}
+            jpegs = {}
+            for width, quality in profiles:
+                if width not in resized:
+                    height = int(frame.shape[0] * width / frame.shape[1])
+                    resized[width] = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA) if width < frame.shape[1] else frame
+                ok, jpeg = cv2.imencode(".jpg", resized[width], [cv2.IMWRITE_JPEG_QUALITY, quality])
+                if ok:
+                    jpegs[(width, quality)] = (sequence, jpeg.tobytes())
+
+            with self._cond:
+                self._encoding = None
+                self._jpegs.update(jpegs)
+                for profile in [p for p, (s, _) in self._jpegs.items() if s < sequence - 250 and self._waiting[p] == 0]:
+                    del self._jpegs[profile]
+                self._cond.notify_all()
+
+    def _add_client(self, count: int) -> None:
+        with self._cond:
+            self._clients += count
+
+    def _wait_for_jpeg(self, profile, last_sequence: int):
+        with self._cond:
+            self._waiting[profile] += 1
+            self._cond.notify_all()
+            try:
+                while self._jpegs.get(profile, (0, None))[0] <= last_sequence:
+                    self._cond.wait()
+                return self._jpegs[profile]
+            finally:
+                self._waiting[profile] -= 1
+
+    def _stream_settings(self, query: dict):
+        """Returns the (width, quality, max fps) for a client, from its query parameters or the remote config."""
+        remote = self._config.remote
+
+        width = int(query.get("width", [remote.stream_max_width])[0])
+        quality = int(query.get("quality", [remote.stream_quality])[0])
+        fps = float(query.get("fps", [remote.stream_max_fps])[0])
+
+        if width <= 0:
+            width = remote.camera_resolution_width
+
+        factor = self._load_factor if remote.stream_auto else 1.0
+        width = max(int(width * factor) // 16 * 16, 160)
+        quality = min(max(int(quality * factor) // 5 * 5, 30), 100)
+        if fps > 0:
+            fps = max(fps * factor, 2)
+
+        return width, quality, fps
 
     def _make_handler(self_mjpeg):  # type: ignore
         class StreamingHandler(BaseHTTPRequestHandler):
@@ -75,31 +156,43 @@ class MJPGServer(StreamServer):
                     self.send_header("Content-Length", str(len(content)))
                     self.end_headers()
                     self.wfile.write(content)
-                elif self.path == "/stream.mjpg":
+                elif urlparse(self.path).path == "/stream.mjpg":
+                    query = parse_qs(urlparse(self.path).query)
                     self.send_response(200)
                     self.send_header("Age", "0")
                     self.send_header("Cache-Control", "no-store, no-cache, must-revalidate, pre-check=0, post-check=0, max-age=0")
                     self.send_header("Pragma", "no-cache")
                     self.send_header("Content-Type", "multipart/x-mixed-replace;boundary=FRAME")
                     self.end_headers()
+                    self_mjpeg._add_client(1)
                     try:
+                        sequence = 0
+                        last_sent = 0
                         while True:
-                            if not self_mjpeg._has_frame:
-                                time.sleep(0.1)
-                            else:
-                                pil_im = Image.fromarray(self_mjpeg._frame)
-                                stream = BytesIO()
-                                pil_im.save(stream, format="JPEG")
-                                frame_data = stream.getvalue()
-
-                                self.wfile.write(b"--FRAME\r\n")
-                                self.send_header("Content-Type", "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7")
-                                self.send_header("Content-Length", str(len(frame_data)))
-                                self.end_headers()
-                                self.wfile.write(frame_data)
-                                self.wfile.write(b"\r\n")
+                            width, quality, fps = self_mjpeg._stream_settings(query)
+                            if fps > 0:
+                                time.sleep(max(last_sent + 1 / fps - time.time(), 0))
+
+                            sequence, frame_data = self_mjpeg._wait_for_jpeg((width, quality), sequence)
+                            last_sent = time.time()
+
+                            self.wfile.write(b"--FRAME\r\n")
+                            self.send_header("Content-Type", "image/jpeg")
+                            self.send_header("Content-Length", str(len(frame_data)))
+                            self.end_headers()
+                            self.wfile.write(frame_data)
+                            self.wfile.write(b"\r\n")
                     except Exception as e:
                         print("Removed streaming client %s: %s", self.client_address, str(e))
+                    finally:
+                        self_mjpeg._add_client(-1)
+                elif self.path == "/metrics" and self_mjpeg._metrics is not None and self_mjpeg._metrics.enabled:
+                    content = self_mjpeg._metrics.prometheus().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
                 else:
                     self.send_error(404)
                     self.end_headers()
@@ -114,10 +207,39 @@ class MJPGServer(StreamServer):
         server = self.StreamingServer((bytes("", "UTF8"), port), self._make_handler())
         server.serve_forever()
         
-    def start(self, config: Config) -> None:
+    def start(self, config: Config, metrics=None) -> None:
+        self._config = config
+        self._metrics = metrics
+        threading.Thread(target=self._encode, daemon=True).start()
         threading.Thread(target=self._run, daemon=True, args=(config.local.stream_port,)).start()
         print(str(datetime.now()) + " - Stream server started on port " + str(config.local.stream_port))
 
-    def set_frame(self, frame: cv2.Mat) -> None:
-        self._frame = frame
-        self._has_frame = True
\ No newline at end of file
+    def has_clients(self) -> bool:
+        return self._clients > 0
+
+    def set_frame(self, frame: cv2.Mat, fpt: float = None) -> None:
+        # Back off stream resolution, quality and rate while the detection loop is over budget on average, and recover at
+        # the same pace once it is comfortably under, so single slow frames and noise around the budget don't move it
+        if fpt is not None and self._config is not None:
+            self._fpt_average += 0.05 * (fpt - self._fpt_average)
+            budget = self._config.remote.stream_fpt_budget
+            if self._fpt_average > budget:
+                self._load_factor = max(self._load_factor - 0.02, 0.25)
+            elif self._fpt_average < 0.8 * budget:
+                self._load_factor = min(self._load_factor + 0.02, 1.0)
+
+        with self._cond:
+            if self._clients == 0:
+                return
+            target = next((b for b in self._buffers if b is not self._frame and b is not self._encoding
+                           and b.shape == frame.shape and b.dtype == frame.dtype), None)
+            if target is None:
+                target = numpy.empty_like(frame)
+                self._buffers = [b for b in self._buffers if b is self._frame or b is self._encoding] + [target]
+
+        numpy.copyto(target, frame)
+
+        with self._cond:
+            self._frame = target
+            self._sequence += 1
+            self._cond.notify_all()
\ No newline at end of file
@@ -0,0 +1,133 @@
+"""
+Copyright (c) 2023-2024 Ivan Chen, StuyPulse
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/license/MIT.
+"""
+
+import time
+import cv2
+
+from config.Config import Config
+from output.Metrics import Metrics
+from output.Publisher import NTPublisher
+from output.Stream import MJPGServer
+from pipeline.Capture import Capture
+from pipeline.Detector import FiducialDetector
+from pipeline.ExposureController import ExposureController
+from pipeline.PoseEstimator import CameraObservation, FiducialPoseEstimator
+from pipeline.PoseFilter import PoseFilter
+
+class Camera:
+    """One camera's capture, detection, pose estimation and outputs. Everything it holds is only touched by one thread at a time."""
+
+    def __init__(self, config: Config, capture: Capture, detector: FiducialDetector, pose_estimator: FiducialPoseEstimator,
+                 publisher: NTPublisher, stream: MJPGServer, metrics: Metrics):
+        self.config = config
+        self.capture = capture
+        self.detector = detector
+        self.pose_estimator = pose_estimator
+        self.publisher = publisher
+        self.stream = stream
+        self.metrics = metrics
+        self.pose_filter = PoseFilter() if config.local.pose_filter else None
+        self.exposure_controller = ExposureController(config) if config.local.exposure_control else None
+
+        self.start_time = time.time()
+        self.counter = 0
+        self.fps = 0
+        # The last frame's tags and pose, for solving a pose jointly across cameras
+        self.observation = None
+
+    def process(self) -> None:
+        """Captures, processes and publishes one frame."""
+        config = self.config
+        metrics = self.metrics
+        self.observation = None
+
+        loop_start = span = metrics.start()
+        fpt_start = time.time()
+        self.counter += 1
+
+        frame_buffer = self.capture.getFrame(config)
+        span = metrics.record("capture", span)
+
+        if frame_buffer is None:
+            self.publisher.sendMsg("Camera not connected")
+            self.publisher.send(0, 0, None, None, [], None)
+            self.capture.release()
+            return
+
+        # Switch calibrations as soon as the camera delivers a different resolution
+        if config.local.calibrations is not None:
+            message = config.local.calibrations.apply(config, *frame_buffer.image.shape[:2])
+            if message is not None:
+                self.publisher.sendMsg(message)
+
+        frame = frame_buffer.image
+        undistorter = config.local.undistorter
+        if undistorter is not None:
+            frame = undistorter.undistortFrame(frame)
+            span = metrics.record("undistort", span)
+
+        fiducials, tids, all_corners = self.detector.detect(frame)
+        span = metrics.record("detect", span)
+
+        if self.exposure_controller is not None:
+            controller = self.exposure_controller
+            controls = controller.update(frame, all_corners)
+            if controls is not None:
+                self.capture.setControls(controls)
+            self.publisher.sendExposure(controller.exposure, controller.gain, controller.brightness, controller.detection_rate, controller.sharpness)
+            span = metrics.record("exposure", span)
+
+        # Only rebuild color and draw when someone is watching the stream
+        if self.stream.has_clients():
+            frame = frame_buffer.color() if undistorter is None else undistorter.undistortFrame(frame_buffer.color(), color=True)
+            if tids is not None and all_corners is not None:
+                frame = cv2.aruco.drawDetectedMarkers(frame, all_corners, tids)
+            span = metrics.record("draw", span)
+
+        if undistorter is not None:
+            fiducials, all_corners = undistorter.undistortCorners(fiducials, all_corners)
+
+        areas = []
+        if tids is not None and all_corners is not None:
+            tids, areas, _, _, _ = self.detector.orderIDs(all_corners, tids)
+        span = metrics.record("order", span)
+
+        tids, primary_pose, reprojection_error = self.pose_estimator.process(fiducials, config)
+        ambiguity = self.pose_estimator.ambiguity
+        span = metrics.record("solve", span)
+
+        pose_std = None
+        if self.pose_filter is not None and primary_pose is not None:
+            primary_pose, pose_std = self.pose_filter.update(primary_pose, reprojection_error, len(tids), self.pose_estimator.tag_distance, frame_buffer.timestamp)
+            span = metrics.record("filter", span)
+
+        if primary_pose is not None:
+            self.observation = CameraObservation(config, fiducials, primary_pose, reprojection_error, frame_buffer.timestamp, areas)
+
+        if (time.time() - self.start_time) > 1:
+            self.fps = self.counter / (time.time() - self.start_time)
+            self.start_time = time.time()
+            self.counter = 0
+            self.publisher.sendDroppedFrames(self.capture.droppedFrames())
+
+        fpt = time.time() - fpt_start
+
+        self.publisher.send(self.fps, fpt, tids, primary_pose, areas, reprojection_error, frame_buffer.timestamp, pose_std)
+        self.publisher.sendAmbiguity(ambiguity)
+        span = metrics.record("publish", span)
+        self.stream.set_frame(frame, fpt)
+        frame_buffer.release()
+        metrics.record("stream", span)
+        metrics.record("total", loop_start)
+
+        if metrics.due():
+            self.publisher.sendTiming(metrics.summary())
+
+    def release(self) -> None:
+        self.capture.release()
+        self.publisher.close()
@@ -6,14 +6,18 @@ license that can be found in the LICENSE file or at
 https://opensource.org/license/MIT.
 """
 
+import os
+import time
 import cv2
+import numpy
 import dataclasses
 from datetime import datetime
-from threading import Thread, Condition
+from threading import Thread, Condition, Lock, current_thread
 import subprocess
 
 from config.Config import Config
 from output.Publisher import NTPublisher
+from pipeline.ExposureController import ExposureController
 
 class Capture:
     def __init__(self) -> None:
@@ -24,66 +28,299 @@ class Capture:
     
     def release(self) -> None:
         raise NotImplementedError
+
+    def droppedFrames(self) -> int:
+        """Number of frames the camera delivered that were never handed to the caller."""
+        return 0
+
+    def setControls(self, controls: dict) -> None:
+        """Sets camera controls, as {property id: value}, on the running capture."""
+        pass
     
     @classmethod
-    def configChanged(cls, config_a: Config, config_b: Config) -> bool:
-        if config_a == None or config_b == None:
-            return True
+    def resolutionChanged(cls, config_a: Config, config_b: Config) -> bool:
+        return config_a.remote.camera_resolution_width != config_b.remote.camera_resolution_width or config_a.remote.camera_resolution_height != config_b.remote.camera_resolution_height
+
+    @classmethod
+    def controlChanges(cls, config_a: Config, config_b: Config) -> dict:
+        """The camera controls that differ between two configs, as {property id: value in config_b}. These can be set on a running stream."""
+        controls = {
+            cv2.CAP_PROP_AUTO_EXPOSURE: (config_a.remote.camera_auto_exposure, config_b.remote.camera_auto_exposure),
+            cv2.CAP_PROP_EXPOSURE: (config_a.remote.camera_exposure, config_b.remote.camera_exposure),
+            cv2.CAP_PROP_GAIN: (config_a.remote.camera_gain, config_b.remote.camera_gain),
+            cv2.CAP_PROP_BRIGHTNESS: (config_a.remote.camera_brightness, config_b.remote.camera_brightness),
+        }
+        return {prop: b for prop, (a, b) in controls.items() if a != b}
 
-        remote_a = config_a.remote
-        remote_b = config_b.remote
+class FrameBuffer:
+    """
+    One preallocated slot of a FrameRing. Whoever holds a reference owns the image
+    and may draw on it; the capture thread never writes into a referenced slot.
+    """
 
-        return remote_a.camera_id != remote_b.camera_id or remote_a.camera_resolution_width != remote_b.camera_resolution_width or remote_a.camera_resolution_height != remote_b.camera_resolution_height or remote_a.camera_auto_exposure != remote_b.camera_auto_exposure or remote_a.camera_exposure != remote_b.camera_exposure or remote_a.camera_gain != remote_b.camera_gain or remote_a.camera_brightness != remote_b.camera_brightness or remote_a.fiducial_size != remote_b.fiducial_size or remote_a.fiducial_layout != remote_b.fiducial_layout
-                
-class WebcamVideoStream:
-    def __init__(self, config: Config, src=0):
+    def __init__(self, ring, image, raw=None):
+        self.ring = ring
+        self.image = image
+        self.raw = raw
+        self.refs = 0
+        self.sequence = 0
+        # time.monotonic() seconds at which the frame was captured
+        self.timestamp = 0.0
+
+    def color(self):
+        """Returns a BGR version of the frame, rebuilding it from the raw capture if the frame is grayscale."""
+        if self.image.ndim == 3:
+            return self.image
+        if self.ring.capture_format == "yuyv" and self.raw is not None:
+            return cv2.cvtColor(self.raw, cv2.COLOR_YUV2BGR_YUYV)
+        if self.ring.capture_format == "gray" and self.raw is not None:
+            return cv2.imdecode(self.raw, cv2.IMREAD_COLOR)
+        return cv2.cvtColor(self.image, cv2.COLOR_GRAY2BGR)
+
+    def acquire(self) -> "FrameBuffer":
+        with self.ring.cond:
+            self.refs += 1
+        return self
 
+    def release(self) -> None:
+        with self.ring.cond:
+            # A slot released twice would sit at -1 and never be written again
+            if self.refs <= 0:
+                return
+            self.refs -= 1
+            self.ring.cond.notify_all()
+
+class FrameRing:
+    def __init__(self, size: int, shape, dtype=numpy.uint8, raw_shape=None, capture_format="bgr"):
         self.cond = Condition()
+        self.capture_format = capture_format
+        self.buffers = [FrameBuffer(self, numpy.empty(shape, dtype), numpy.empty(raw_shape, dtype) if raw_shape is not None else None)
+                        for _ in range(size)]
+        self.latest = None
+        self.sequence = 0
+
+    def writable(self, wait: bool = False):
+        """Returns a free slot owned by the caller, or None if every slot is still in use downstream and wait is not set."""
+        with self.cond:
+            while True:
+                for buffer in self.buffers:
+                    if buffer.refs == 0:
+                        buffer.refs = 1
+                        return buffer
+                if not wait:
+                    return None
+                self.cond.wait()
+
+    def publish(self, buffer: FrameBuffer, sequence: int = None) -> None:
+        """
+        Makes a filled slot the newest frame. The ring keeps the writer's reference until the next publish.
+        sequence numbers the frame as the camera delivered it, so gaps show frames that were never published.
+        """
+        with self.cond:
+            previous = self.latest
+            self.sequence = sequence if sequence is not None else self.sequence + 1
+            buffer.sequence = self.sequence
+            self.latest = buffer
+            if previous is not None:
+                previous.refs -= 1
+            self.cond.notify_all()
+
+class WebcamVideoStream:
+    def __init__(self, config: Config, src=0, buffers=4):
+
+        # "bgr" decodes full color frames, "gray" decodes the MJPEG luminance only, "yuyv" takes the Y plane of raw YUYV frames
+        self.capture_format = config.local.capture_format
+        # Only decode a grabbed frame when a reader is already waiting for it, so it is never older than one grab
+        self.low_latency = config.local.low_latency
 
         self.stream = cv2.VideoCapture(src)
-        self.stream.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter.fourcc(*"MJPG"))
+        self.stream.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter.fourcc(*("YUYV" if self.capture_format == "yuyv" else "MJPG")))
+        if self.capture_format != "bgr":
+            self.stream.set(cv2.CAP_PROP_CONVERT_RGB, 0)
         self.stream.set(cv2.CAP_PROP_FRAME_HEIGHT, config.remote.camera_resolution_height)
         self.stream.set(cv2.CAP_PROP_FRAME_WIDTH, config.remote.camera_resolution_width)
         self.stream.set(cv2.CAP_PROP_FPS, 50)
-        self.stream.set(cv2.CAP_PROP_AUTO_EXPOSURE, config.remote.camera_auto_exposure)
+        if self.low_latency:
+            self.stream.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        # The exposure controller needs the camera's own auto exposure off
+        self.stream.set(cv2.CAP_PROP_AUTO_EXPOSURE, ExposureController.manual_exposure if config.local.exposure_control else config.remote.camera_auto_exposure)
         self.stream.set(cv2.CAP_PROP_EXPOSURE, config.remote.camera_exposure)
         self.stream.set(cv2.CAP_PROP_GAIN, config.remote.camera_gain)
         self.stream.set(cv2.CAP_PROP_BRIGHTNESS, config.remote.camera_brightness)
 
-        self.grabbed, self.frame = self.stream.read()
-        self.has_read = False
+        self.buffers = buffers
+        self.grabs = 0
+        self.ring = self.startRing()
+        self.waiting = 0
+        self.dropped = 0
+        self.last_sequence = 0
         self.stopped = False
+        self.thread = None
+
+        # Control and resolution changes waiting for the capture thread, which applies them between grabs
+        self.lock = Lock()
+        self.requests = {}
+        self.requested_resolution = None
+
+    def startRing(self):
+        """Reads the first frame and returns a ring sized for it with that frame published, or None if the camera gave no frame."""
+        self.grabbed, frame = self.stream.read()
+        if self.grabbed and self.capture_format == "gray":
+            frame = self.decodeGray(frame)
+            self.grabbed = frame is not None
+        if not self.grabbed:
+            return None
+
+        if self.capture_format == "yuyv":
+            ring = FrameRing(self.buffers, frame.shape[:2], frame.dtype, frame.shape, self.capture_format)
+        else:
+            ring = FrameRing(self.buffers, frame.shape, frame.dtype, None, self.capture_format)
+        buffer = ring.writable()
+        if not self.fill(buffer, frame):
+            numpy.copyto(buffer.image, frame)
+        buffer.timestamp = self.frameTimestamp(time.monotonic())
+        self.grabs += 1
+        ring.publish(buffer, self.grabs)
+        return ring
 
     def start(self):
-        t = Thread(target=self.update, args=())
-        t.daemon = True
-        t.start()
+        self.thread = Thread(target=self.update, args=())
+        self.thread.daemon = True
+        self.thread.start()
         return self
     
     def set(self, propId, value):
-        self.stream.set(propId, value)
+        """Queues a camera control change. It is applied between two grabs, so no frames are lost."""
+        with self.lock:
+            self.requests[propId] = value
+
+    def resize(self, width: int, height: int) -> None:
+        """Queues a resolution change. The open stream is switched to the new mode without reopening the device."""
+        with self.lock:
+            self.requested_resolution = (width, height)
+
+    def applyRequests(self) -> None:
+        with self.lock:
+            requests, self.requests = self.requests, {}
+            resolution, self.requested_resolution = self.requested_resolution, None
+
+        for propId, value in requests.items():
+            self.stream.set(propId, value)
+
+        if resolution is not None:
+            # OpenCV restarts the V4L2 stream in the new format, frames from the old ring stay valid until released
+            self.stream.set(cv2.CAP_PROP_FRAME_WIDTH, resolution[0])
+            self.stream.set(cv2.CAP_PROP_FRAME_HEIGHT, resolution[1])
+            ring = self.startRing()
+            previous = self.ring
+            with previous.cond:
+                if ring is not None:
+                    self.ring = ring
+                previous.cond.notify_all()
 
     def update(self):
-        while True:
+        while self.ring is not None:
             if self.stopped:
                 return
-            
-            self.grabbed, self.frame = self.stream.read()
 
-            with self.cond:
-                self.has_read = False
-                self.cond.notify_all()
+            if len(self.requests) > 0 or self.requested_resolution is not None:
+                self.applyRequests()
+
+            self.grabbed = self.stream.grab()
+            grab_time = time.monotonic()
+            if self.grabbed:
+                self.grabs += 1
+
+            # Drop the frame without decoding it if every slot is still held downstream, or nobody is waiting for it in low latency mode
+            buffer = self.ring.writable() if self.grabbed and (self.waiting > 0 or not self.low_latency) else None
+            if buffer is not None:
+                self.grabbed = self.fill(buffer)
+                if self.grabbed:
+                    buffer.timestamp = self.frameTimestamp(grab_time)
+                    self.ring.publish(buffer, self.grabs)
+                else:
+                    buffer.release()
+
+            if not self.grabbed:
+                with self.ring.cond:
+                    self.ring.cond.notify_all()
+
+    def fill(self, buffer: FrameBuffer, frame=None) -> bool:
+        """Decodes the last grabbed frame (or the given raw frame) into the buffer's preallocated image."""
+        if self.capture_format == "bgr":
+            if frame is not None:
+                return False
+            ok, image = self.stream.retrieve(buffer.image)
+            if ok:
+                buffer.image = image
+            return ok
+
+        if self.capture_format == "yuyv":
+            if frame is None:
+                ok, frame = self.stream.retrieve(buffer.raw)
+                if not ok:
+                    return False
+            buffer.raw = frame
+            cv2.cvtColor(frame, cv2.COLOR_YUV2GRAY_YUYV, buffer.image)
+            return True
+
+        if frame is None:
+            ok, raw = self.stream.retrieve()
+            if not ok:
+                return False
+            frame = self.decodeGray(raw)
+            if frame is None or frame.shape != buffer.image.shape:
+                return False
+            buffer.raw = raw
+        numpy.copyto(buffer.image, frame)
+        return True
+
+    def frameTimestamp(self, grab_time: float) -> float:
+        """
+        The driver's buffer timestamp when it is usable, otherwise the host time at grab.
+        V4L2 stamps buffers with CLOCK_MONOTONIC, the same clock as time.monotonic(), but
+        other backends report stream position instead, so anything implausible is ignored.
+        """
+        driver_time = self.stream.get(cv2.CAP_PROP_POS_MSEC) / 1000
+        if 0 <= grab_time - driver_time < 0.5:
+            return driver_time
+        return grab_time
+
+    def decodeGray(self, raw):
+        # V4L2 hands back the undecoded MJPEG bytes as a single row, other backends may have decoded it already
+        if raw.ndim == 1 or raw.shape[0] == 1:
+            return cv2.imdecode(raw, cv2.IMREAD_GRAYSCALE)
+        if raw.ndim == 3:
+            return cv2.cvtColor(raw, cv2.COLOR_BGR2GRAY)
+        return raw
 
-    
     def read(self):
-        with self.cond:
-            while self.has_read:
-                self.cond.wait()
-            self.has_read = True
-            return self.frame
+        """Returns the newest unread frame as a FrameBuffer owned by the caller, who must release it."""
+        while True:
+            ring = self.ring
+            if ring is None:
+                return None
+            with ring.cond:
+                self.waiting += 1
+                while self.grabbed and ring is self.ring and (ring.latest is None or ring.latest.sequence == self.last_sequence):
+                    ring.cond.wait()
+                self.waiting -= 1
+                # The resolution changed while waiting, wait on the new ring instead
+                if ring is not self.ring:
+                    continue
+                if not self.grabbed:
+                    return None
+                if self.last_sequence > 0:
+                    self.dropped += ring.latest.sequence - self.last_sequence - 1
+                self.last_sequence = ring.latest.sequence
+                ring.latest.refs += 1
+                return ring.latest
     
     def release(self):
         self.stopped = True
+        # Let the capture thread finish its grab before the device goes away underneath it
+        if self.thread is not None:
+            self.thread.join(timeout=1)
         self.stream.release()
 
 class DefaultCapture(Capture):
@@ -92,25 +329,224 @@ class DefaultCapture(Capture):
     last_config: Config = None
     publisher: NTPublisher = None
 
+    # A stream for another camera, opened on a background thread while the current one keeps serving frames
+    pending = None
+    preparing: Thread = None
+    pending_id: int = None
+    # Camera of the running stream
+    video_id: int = None
+
     def __init__(self, publisher: NTPublisher) -> None:
         self.publisher = publisher
-        pass
+        self.lock = Lock()
+        # Control and resolution changes made while another camera opens, applied to it when it takes over
+        self.pending_controls = {}
+        self.pending_resolution = None
     
-    def getFrame(self, config: Config):
+    def getFrame(self, config: Config) -> FrameBuffer:
 
         if self.video == None and config != None:
             self.publisher.sendMsg(str(datetime.now()) + " - Starting video capture")
             print(str(datetime.now()) + " - Starting video capture")
-            self.video = WebcamVideoStream(config, src=0).start()
+            self.video = self.openStream(config).start()
+            self.video_id = self.cameraId(config)
             self.publisher.sendMsg(str(datetime.now()) + " - Video capture successfully started")
             print(str(datetime.now()) + " - Video capture successfully started")
-            self.last_config = Config(dataclasses.replace(config.local), dataclasses.replace(config.remote))
-            if config.local.server_ip != "127.0.0.1": subprocess.run(["v4l2-ctl", "-d", "/dev/video0", "-c", "exposure_absolute=8"])
+            self.last_config = self.snapshot(config)
+        elif config != None and config.version != self.last_config.version:
+            self.reconfigure(config)
+
+        if self.preparing is not None and not self.preparing.is_alive():
+            self.swap()
 
         return self.video.read()
+
+    def reconfigure(self, config: Config) -> None:
+        """
+        Applies camera setting changes without restarting the capture. Controls are set on the running stream,
+        a resolution change switches the open stream's mode, and a camera change opens the new camera in the background.
+        Changes made while the new camera opens are carried over to it when it takes over.
+        """
+        last_config = self.last_config
+        self.last_config = self.snapshot(config)
+
+        if self.cameraId(config) != self.cameraId(last_config):
+            if self.cameraId(config) != self.video_id:
+                self.prepare(config)
+                return
+            # Switched back to the running camera before the other one opened
+            self.cancel()
+
+        if self.resolutionChanged(last_config, config):
+            resolution = (config.remote.camera_resolution_width, config.remote.camera_resolution_height)
+            self.publisher.sendMsg(str(datetime.now()) + " - Switching resolution to " + str(resolution[0]) + "x" + str(resolution[1]))
+            self.video.resize(*resolution)
+            with self.lock:
+                if self.preparing is not None:
+                    self.pending_resolution = resolution
+
+        controls = self.controlChanges(last_config, config)
+        # The exposure controller owns these, and would otherwise keep stepping from values the camera no longer has
+        if config.local.exposure_control:
+            for propId in [cv2.CAP_PROP_AUTO_EXPOSURE, cv2.CAP_PROP_EXPOSURE, cv2.CAP_PROP_GAIN]:
+                controls.pop(propId, None)
+        self.setControls(controls)
+
+    def prepare(self, config: Config) -> None:
+        # An earlier camera change that is still opening releases its stream once open, so it doesn't hold up frames here.
+        # Its recorded controls are the running stream's latest and still apply to this camera.
+        with self.lock:
+            pending, self.pending, self.preparing = self.pending, None, None
+        if pending is not None:
+            pending.release()
+
+        self.publisher.sendMsg(str(datetime.now()) + " - Opening camera " + str(self.cameraId(config)))
+        snapshot = self.snapshot(config)
+
+        def openPending():
+            video = self.openStream(snapshot)
+            with self.lock:
+                if current_thread() is self.preparing:
+                    self.pending = video
+                    return
+            video.release()
+
+        with self.lock:
+            self.preparing = Thread(target=openPending, daemon=True)
+            self.pending_id = self.cameraId(config)
+        self.preparing.start()
+
+    def cancel(self) -> None:
+        """Drops a camera change in progress."""
+        with self.lock:
+            pending, self.pending, self.preparing = self.pending, None, None
+            self.pending_controls = {}
+            self.pending_resolution = None
+        if pending is not None:
+            pending.release()
+
+    def swap(self) -> None:
+        with self.lock:
+            video, self.pending, self.preparing = self.pending, None, None
+            controls, self.pending_controls = self.pending_controls, {}
+            resolution, self.pending_resolution = self.pending_resolution, None
+
+        if video is None or video.ring is None:
+            self.publisher.sendMsg(str(datetime.now()) + " - Could not open camera " + str(self.pending_id) + ", keeping the current camera")
+            if video is not None:
+                video.release()
+            return
+
+        # Queued before the capture thread starts, so they apply before its first grab
+        for propId, value in controls.items():
+            video.set(propId, value)
+        if resolution is not None:
+            video.resize(*resolution)
+
+        previous, self.video, self.video_id = self.video, video.start(), self.pending_id
+        previous.release()
+        self.publisher.sendMsg(str(datetime.now()) + " - Switched to camera " + str(self.video_id))
+
+    def setControls(self, controls: dict) -> None:
+        if self.video is not None:
+            for propId, value in controls.items():
+                self.video.set(propId, value)
+        with self.lock:
+            if self.preparing is not None:
+                self.pending_controls.update(controls)
+
+    def openStream(self, config: Config) -> WebcamVideoStream:
+        video = WebcamVideoStream(config, src=self.cameraId(config), buffers=10 if config.local.pipelined else 4)
+        # The exposure controller sets exposure itself
+        if config.local.server_ip != "127.0.0.1" and not config.local.exposure_control: subprocess.run(["v4l2-ctl", "-d", "/dev/video" + str(self.cameraId(config)), "-c", "exposure_absolute=8"])
+        return video
+
+    def snapshot(self, config: Config) -> Config:
+        return Config(dataclasses.replace(config.local), dataclasses.replace(config.remote), config.version)
+
+    def cameraId(self, config: Config) -> int:
+        """The camera listed in config.json for multi-camera devices, otherwise camera_id from NetworkTables."""
+        return config.local.camera_id if config.local.camera_id >= 0 else config.remote.camera_id
+
+    def droppedFrames(self) -> int:
+        return self.video.dropped if self.video is not None else 0
     
     def release(self) -> None:
         self.publisher.sendMsg(str(datetime.now()) + " - Releasing video capture")
         print(str(datetime.now()) + " - Releasing video capture")
+        self.cancel()
         if self.video != None: self.video.release()
         self.video = None
+
+class ReplayCapture(Capture):
+    """Plays back recorded frames from a folder of images or a video file instead of a live camera."""
+
+    IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+    ring: FrameRing = None
+
+    def __init__(self, path: str, fps: float = 0, loop: bool = False, buffers: int = 4) -> None:
+        self.path = path
+        self.fps = fps
+        self.loop = loop
+        self.buffers = buffers
+
+        self.files = None
+        self.video = None
+        self.index = 0
+        self.current = None
+        self.next_time = 0.0
+
+        if os.path.isdir(path):
+            self.files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(self.IMAGE_EXTENSIONS))
+        else:
+            self.video = cv2.VideoCapture(path)
+
+    def __len__(self) -> int:
+        if self.files is not None:
+            return len(self.files)
+        return int(self.video.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    def readImage(self, gray: bool):
+        if self.files is not None:
+            if self.index >= len(self.files):
+                if not self.loop or len(self.files) == 0:
+                    return None
+                self.index = 0
+            self.current = self.files[self.index]
+            image = cv2.imread(self.current, cv2.IMREAD_GRAYSCALE if gray else cv2.IMREAD_COLOR)
+            self.index += 1
+            return image
+
+        grabbed, image = self.video.read()
+        if not grabbed and self.loop:
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            grabbed, image = self.video.read()
+        if not grabbed:
+            return None
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if gray else image
+
+    def getFrame(self, config: Config) -> FrameBuffer:
+        # Throttle to the recorded frame rate, or replay as fast as possible if fps is 0
+        if self.fps > 0:
+            delay = self.next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.next_time = max(self.next_time, time.perf_counter()) + 1 / self.fps
+
+        image = self.readImage(config.local.capture_format != "bgr")
+        if image is None:
+            return None
+
+        if self.ring is None or self.ring.buffers[0].image.shape != image.shape:
+            self.ring = FrameRing(self.buffers, image.shape, image.dtype, None, config.local.capture_format)
+
+        buffer = self.ring.writable(wait=True)
+        numpy.copyto(buffer.image, image)
+        buffer.timestamp = time.monotonic()
+        self.ring.publish(buffer)
+        return buffer.acquire()
+
+    def release(self) -> None:
+        if self.video is not None:
+            self.video.release()
@@ -21,11 +21,23 @@ class Detector:
         raise NotImplementedError
     
 class FiducialDetector:
+
+    tracked_corners = None
+    tracked_ids = None
+    frames_since_full_search = 0
+
     def __init__(self, config: Config):
+        self.config = config
         self.detector = cv2.aruco.ArucoDetector(config.local.detection_dictionary, config.local.aruco_parameters)
+        self.roi_tracking = config.local.roi_tracking
+        self.roi_full_search_interval = config.local.roi_full_search_interval
+        self.roi_padding = config.local.roi_padding
 
     def detect(self, image):
-        all_corners, ids, rejected = self.detector.detectMarkers(image)
+        if self.roi_tracking:
+            all_corners, ids = self.detectTracked(image)
+        else:
+            all_corners, ids = self.detectMarkers(image)
 
         fiducials = []
 
@@ -35,54 +47,109 @@ class FiducialDetector:
             return fiducials, ids, all_corners
         return None, None, None
 
-    def orderIDs(self, corners, ids): 
-
-        if (numpy.asarray(ids).flatten().tolist() == []): return None
-        
-        corners = numpy.asarray(corners).flatten().tolist()
-        ids = numpy.asarray(ids).flatten().tolist()
-
-        areas = []
-
-        for i in range(len(ids)):
-            subX = corners[i * 8 + 0]
-            subY = corners[i * 8 + 1]
-
-            corners[i * 8 + 0] -= subX
-            corners[i * 8 + 1] -= subY
-            corners[i * 8 + 2] -= subX
-            corners[i * 8 + 3] -= subY
-            corners[i * 8 + 4] -= subX
-            corners[i * 8 + 5] -= subY
-            corners[i * 8 + 6] -= subX
-            corners[i * 8 + 7] -= subY
-
-            s1 = 0
-            s2 = 0
-
-            s1 += corners[i * 8 + 0] * corners[i * 8 + 3]
-            s1 += corners[i * 8 + 2] * corners[i * 8 + 5]
-            s1 += corners[i * 8 + 4] * corners[i * 8 + 7]
-            s1 += corners[i * 8 + 6] * corners[i * 8 + 1]
-
-            s2 += corners[i * 8 + 1] * corners[i * 8 + 2]
-            s2 += corners[i * 8 + 3] * corners[i * 8 + 3]
-            s2 += corners[i * 8 + 5] * corners[i * 8 + 6]
-            s2 += corners[i * 8 + 7] * corners[i * 8 + 0]
-
-            areas.append(abs(s1 - s2) / 2)
-
-        outAreas = []
-        outIDs = []
-        
-        while areas:
-            smallest = min(areas)
-            index = areas.index(smallest)
-
-            outAreas.append(areas.pop(index))
-            outIDs.append(ids.pop(index))
-
-        outIDs.reverse()
-        outAreas.reverse()
-        
-        return numpy.asarray(outIDs), outAreas
+    def detectMarkers(self, image):
+        scale = self.config.remote.detection_scale
+
+        if scale <= 0 or scale >= 1:
+            all_corners, ids, rejected = self.detector.detectMarkers(image)
+            return all_corners, ids
+
+        # Find candidate quads on the downscaled image, then refine the scaled-up corners at full resolution
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        all_corners, ids, rejected = self.detector.detectMarkers(small)
+        if ids is None:
+            return None, None
+
+        corners = (numpy.concatenate(all_corners).reshape(-1, 2) + 0.5) / scale - 0.5
+        sides = numpy.linalg.norm(corners.reshape(-1, 4, 2) - numpy.roll(corners.reshape(-1, 4, 2), 1, axis=1), axis=2)
+        window = max(min(int(round(2 / scale)) + 1, int(sides.min() / 4)), 2)
+
+        corners = numpy.ascontiguousarray(corners, dtype=numpy.float32)
+        cv2.cornerSubPix(gray, corners, (window, window), (-1, -1), (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 30, 0.01))
+
+        return tuple(corners.reshape(-1, 1, 4, 2)), ids
+
+    def detectTracked(self, image):
+        if self.tracked_ids is not None and self.frames_since_full_search < self.roi_full_search_interval:
+            self.frames_since_full_search += 1
+            all_corners, ids = self.detectROIs(image, self.tracked_corners)
+
+            # Fall back to a full-frame search as soon as a tracked tag is lost
+            if ids is not None and set(self.tracked_ids.flatten()) <= set(ids.flatten()):
+                self.tracked_corners, self.tracked_ids = all_corners, ids
+                return all_corners, ids
+
+        self.frames_since_full_search = 0
+        all_corners, ids = self.detectMarkers(image)
+        self.tracked_corners, self.tracked_ids = (all_corners, ids) if ids is not None else (None, None)
+        return all_corners, ids
+
+    def detectROIs(self, image, previous_corners):
+        height, width = image.shape[:2]
+
+        rois = []
+        for corners in previous_corners:
+            corners = corners.reshape(4, 2)
+            x_min, y_min = corners.min(axis=0)
+            x_max, y_max = corners.max(axis=0)
+            pad = max(x_max - x_min, y_max - y_min) * self.roi_padding + 8
+            rois.append([max(int(x_min - pad), 0), max(int(y_min - pad), 0),
+                         min(int(x_max + pad) + 1, width), min(int(y_max + pad) + 1, height)])
+
+        # Merge overlapping regions so a tag is never cut in half by a neighbouring crop
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(rois)):
+                for j in range(i + 1, len(rois)):
+                    a, b = rois[i], rois[j]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        rois[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                        rois.pop(j)
+                        merged = True
+                        break
+                if merged:
+                    break
+
+        all_corners = []
+        all_ids = []
+        for x0, y0, x1, y1 in rois:
+            roi_corners, roi_ids = self.detectMarkers(image[y0:y1, x0:x1])
+            if roi_ids is None:
+                continue
+            for tid, corners in zip(roi_ids, roi_corners):
+                if tid[0] in all_ids:
+                    continue
+                all_corners.append(corners + numpy.array([x0, y0], dtype=numpy.float32))
+                all_ids.append(tid[0])
+
+        if len(all_ids) == 0:
+            return None, None
+        return tuple(all_corners), numpy.array(all_ids, dtype=numpy.int32).reshape(-1, 1)
+
+    def orderIDs(self, corners, ids):
+        """
+        Sorts the markers from largest to smallest area. Returns the ids, areas, corners, perimeters
+        and aspect ratios (longer over shorter mean side length) of each marker in that order.
+        """
+
+        ids = numpy.asarray(ids).reshape(-1)
+        if len(ids) == 0: return None
+
+        corners = numpy.asarray(corners, dtype=numpy.float64).reshape(-1, 4, 2)
+        next_corners = numpy.roll(corners, -1, axis=1)
+
+        # Shoelace formula over all markers at once
+        areas = numpy.abs(numpy.sum(corners[:, :, 0] * next_corners[:, :, 1] - next_corners[:, :, 0] * corners[:, :, 1], axis=1)) / 2
+
+        sides = numpy.linalg.norm(next_corners - corners, axis=2)
+        perimeters = sides.sum(axis=1)
+        widths = (sides[:, 0] + sides[:, 2]) / 2
+        heights = (sides[:, 1] + sides[:, 3]) / 2
+        aspect_ratios = numpy.maximum(widths, heights) / numpy.maximum(numpy.minimum(widths, heights), 1e-9)
+
+        order = numpy.argsort(-areas, kind="stable")
+
+        return ids[order], areas[order], corners[order], perimeters[order], aspect_ratios[order]
@@ -0,0 +1,154 @@
+"""
+Copyright (c) 2023-2024 Ivan Chen, StuyPulse
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/license/MIT.
+"""
+
+import cv2
+import numpy
+
+from config.Config import Config
+
+class ExposureController:
+    """
+    Adjusts exposure and gain so detected tags are well exposed rather than the image as a whole. Brightens with gain
+    before exposure and darkens with exposure before gain, so frames stay as short as the light allows and motion
+    blur stays low. While the tags' edges are blurred it trades exposure for gain. Exposure never goes past
+    max_exposure. Once tags are missing from most recent frames it falls back to frame brightness.
+    """
+
+    # V4L2 CAP_PROP_AUTO_EXPOSURE value for manual exposure, 3 is aperture priority auto exposure
+    manual_exposure = 1
+    # Shortest exposure the controller uses, DefaultCapture otherwise forces 8 through v4l2-ctl
+    min_exposure = 2
+    # Gain is raised to this before exposure, and past it only once exposure is at max_exposure or the tags are blurred
+    preferred_gain = 32
+    max_gain = 128
+    gain_step = 4
+    # 95th percentile brightness of the pixels around detected tags, so their white cells are bright but not clipped
+    tag_target = 180
+    # Mean brightness to aim for while no tags are seen
+    frame_target = 100
+    deadband = 0.15
+    # Frames for a change to take effect before measuring again
+    settle_frames = 3
+    # Below this fraction of recent frames with tags, missed frames are exposed for the whole frame
+    search_rate = 0.5
+    # Steepest edge step across the tags relative to their contrast, about 1 when sharp and 2 / blur length in pixels
+    min_sharpness = 0.35
+
+    def __init__(self, config: Config):
+        self.max_exposure = max(config.local.max_exposure, self.min_exposure)
+        self.exposure = int(min(max(config.remote.camera_exposure, self.min_exposure), self.max_exposure))
+        self.gain = int(min(max(config.remote.camera_gain, 0), self.max_gain))
+        self.brightness = 0.0
+        self.sharpness = 0.0
+        self.detection_rate = 0.0
+        self.frames = 0
+        self.last_change = 0
+
+    def update(self, image, all_corners):
+        """Measures a frame and its detected tags. Returns {property id: value} for the capture when exposure or gain should change, otherwise None."""
+        self.frames += 1
+        detected = all_corners is not None and len(all_corners) > 0
+        self.detection_rate += 0.05 * (detected - self.detection_rate)
+
+        # Take over from the camera's auto exposure before measuring anything
+        if self.frames == 1:
+            self.last_change = self.frames
+            return self.controls()
+
+        # The green channel is close enough to luminance and saves a conversion
+        gray = image[:, :, 1] if image.ndim == 3 else image
+
+        if detected:
+            self.brightness, self.sharpness = self.tagQuality(gray, all_corners)
+            target = self.tag_target
+        elif self.detection_rate < self.search_rate:
+            self.brightness = float(gray[::8, ::8].mean())
+            target = self.frame_target
+        else:
+            # Occasional misses while tags are usually seen say nothing about exposure
+            return None
+
+        if self.frames - self.last_change < self.settle_frames:
+            return None
+
+        blurred = detected and self.sharpness < self.min_sharpness
+        ratio = target / max(self.brightness, 1.0)
+        if abs(ratio - 1) < self.deadband:
+            if not blurred:
+                return None
+            exposure, gain = self.trade()
+        else:
+            exposure, gain = self.step(min(max(ratio, 0.5), 2.0), blurred)
+
+        if exposure == self.exposure and gain == self.gain:
+            return None
+
+        self.exposure, self.gain = exposure, gain
+        self.last_change = self.frames
+        return self.controls()
+
+    def controls(self) -> dict:
+        return {cv2.CAP_PROP_AUTO_EXPOSURE: self.manual_exposure, cv2.CAP_PROP_EXPOSURE: self.exposure, cv2.CAP_PROP_GAIN: self.gain}
+
+    def step(self, ratio: float, blurred: bool = False):
+        """The next exposure and gain for a wanted change in brightness. Blurred tags are brightened with gain up to max_gain first."""
+        exposure, gain = self.exposure, self.gain
+        # Gain units depend on the camera, so it moves in fixed steps, two at a time for large corrections
+        gain_step = self.gain_step * (2 if ratio > 1.5 or ratio < 0.67 else 1)
+        gain_limit = self.max_gain if blurred else self.preferred_gain
+
+        if ratio > 1:
+            if gain < gain_limit:
+                gain = min(gain + gain_step, gain_limit)
+            elif exposure < self.max_exposure:
+                exposure = min(max(int(exposure * ratio), exposure + 1), self.max_exposure)
+            else:
+                gain = min(gain + gain_step, self.max_gain)
+        else:
+            if gain > self.preferred_gain and not blurred:
+                gain = max(gain - gain_step, self.preferred_gain)
+            elif exposure > self.min_exposure:
+                exposure = max(min(int(exposure * ratio), exposure - 1), self.min_exposure)
+            else:
+                gain = max(gain - gain_step, 0)
+
+        return exposure, gain
+
+    def trade(self):
+        """Shortens exposure by a step and makes up for it with gain, for tags that are bright enough but blurred."""
+        if self.exposure <= self.min_exposure or self.gain >= self.max_gain:
+            return self.exposure, self.gain
+        exposure = max(min(int(self.exposure * 0.8), self.exposure - 1), self.min_exposure)
+        return exposure, min(self.gain + self.gain_step, self.max_gain)
+
+    def tagQuality(self, gray, all_corners):
+        """
+        95th percentile brightness of the pixels in the detected tags' bounding boxes, sampled every other pixel, and
+        the median over tags of their steepest edge steps relative to their contrast.
+        """
+        height, width = gray.shape[:2]
+        samples = []
+        sharpness = []
+        for corners in all_corners:
+            corners = numpy.asarray(corners).reshape(-1, 2)
+            x0, y0 = numpy.maximum(corners.min(axis=0).astype(int), 0)
+            x1, y1 = corners.max(axis=0).astype(int) + 1
+            roi = gray[y0:min(y1, height):2, x0:min(x1, width):2]
+            if roi.shape[0] < 2 or roi.shape[1] < 2:
+                continue
+            samples.append(roi.ravel())
+
+            low, high = numpy.percentile(roi, [5, 95])
+            roi = roi.astype(numpy.int16)
+            # Motion blur smears edges along one direction, so take the softer of the two
+            step = min(numpy.percentile(numpy.abs(numpy.diff(roi, axis=0)), 98), numpy.percentile(numpy.abs(numpy.diff(roi, axis=1)), 98))
+            sharpness.append(step / max(high - low, 1.0))
+
+        if len(samples) == 0:
+            return float(gray[::8, ::8].mean()), 1.0
+        return float(numpy.percentile(numpy.concatenate(samples), 95)), float(numpy.median(sharpness))
@@ -0,0 +1,127 @@
+"""
+Copyright (c) 2023-2024 Ivan Chen, StuyPulse
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/license/MIT.
+"""
+
+import traceback
+from dataclasses import dataclass, field
+from threading import Thread, Condition
+from typing import Any, Callable, Union
+
+@dataclass
+class FrameData:
+    frame: Any = None
+    frame_buffer: Any = None
+    fpt_start: float = 0.0
+    # perf_counter_ns at the start of capture, when metrics are enabled
+    loop_start: int = 0
+    fiducials: list = None
+    tids: Any = None
+    all_corners: Any = None
+    areas: list = field(default_factory=list)
+    primary_pose: Any = None
+    reprojection_error: float = None
+    ambiguity: float = 0.0
+    pose_std: list = None
+
+    def release(self) -> None:
+        """Hands the frame buffer back to the capture, at most once."""
+        frame_buffer, self.frame_buffer = self.frame_buffer, None
+        if frame_buffer is not None:
+            frame_buffer.release()
+
+class LatestQueue:
+    """Single-slot queue that only ever holds the newest item. Putting into a full queue replaces the stale item."""
+
+    def __init__(self, on_drop: Union[Callable, None] = None):
+        self.cond = Condition()
+        self.item = None
+        self.has_item = False
+        self.on_drop = on_drop
+
+    def put(self, item) -> None:
+        stale = None
+        with self.cond:
+            if self.has_item:
+                stale = self.item
+            self.item = item
+            self.has_item = True
+            self.cond.notify()
+        if stale is not None and self.on_drop is not None:
+            self.on_drop(stale)
+
+    def get(self):
+        with self.cond:
+            while not self.has_item:
+                self.cond.wait()
+            item = self.item
+            self.item = None
+            self.has_item = False
+            return item
+
+class Stage:
+    def __init__(self, name: str, function: Callable, source: Union[LatestQueue, None], sink: Union[LatestQueue, None],
+                 on_drop: Union[Callable, None] = None, on_error: Union[Callable, None] = None):
+        self.name = name
+        self.function = function
+        self.source = source
+        self.sink = sink
+        self.on_drop = on_drop
+        self.on_error = on_error
+
+    def start(self) -> Thread:
+        t = Thread(target=self.run, name=self.name, args=())
+        t.daemon = True
+        t.start()
+        return t
+
+    def run(self) -> None:
+        while True:
+            item = self.source.get() if self.source is not None else None
+
+            try:
+                result = self.function(item) if self.source is not None else self.function()
+            except Exception as e:
+                # A dead stage would leave every other stage waiting on its queue, so report the error, drop the frame and carry on
+                traceback.print_exc()
+                if item is not None and self.on_drop is not None:
+                    self.on_drop(item)
+                if self.on_error is not None:
+                    self.on_error(self.name, e)
+                continue
+
+            if result is not None and self.sink is not None:
+                self.sink.put(result)
+
+class Pipeline:
+    """
+    Runs each stage on its own thread, connected by single-slot queues so that
+    frame N + 1 can be detected while frame N is being solved. Stages never
+    queue up behind one another; a slow stage only ever sees the newest frame.
+    """
+
+    def __init__(self, on_drop: Union[Callable, None] = None, on_error: Union[Callable, None] = None):
+        self.stages = []
+        self.threads = []
+        self.on_drop = on_drop
+        self.on_error = on_error
+
+    def addStage(self, name: str, function: Callable) -> "Pipeline":
+        source = None
+        if len(self.stages) > 0:
+            source = LatestQueue(self.on_drop)
+            self.stages[-1].sink = source
+        self.stages.append(Stage(name, function, source, None, self.on_drop, self.on_error))
+        return self
+
+    def start(self) -> "Pipeline":
+        self.threads = [stage.start() for stage in self.stages]
+        return self
+
+    def join(self) -> None:
+        while any(t.is_alive() for t in self.threads):
+            for t in self.threads:
+                t.join(0.5)
@@ -6,8 +6,13 @@ license that can be found in the LICENSE file or at
 https://opensource.org/license/MIT.
 """
 
+import math
+import time
 import cv2
 import numpy
+from collections import deque
+from dataclasses import dataclass
+from ntcore import NetworkTableInstance, _now
 from wpimath.geometry import *
 
 from config.Config import Config
@@ -42,107 +47,395 @@ def cvtowpi(tvec, rvec):
 def wpitocv(translation):
     return [-translation.Y(), -translation.Z(), translation.X()]
 
+def transformtocv(transform: Transform3d):
+    """The inverse of cvtowpi: a WPILib transform as an OpenCV (rvec, tvec) pair."""
+    rvec = transform.rotation().axis() * transform.rotation().angle
+    return numpy.array([[-rvec[1]], [-rvec[2]], [rvec[0]]]), numpy.array([wpitocv(transform.translation())]).T
+
+class FiducialLayout:
+    """
+    Field-frame corner coordinates of every tag in the layout, in OpenCV axes, indexed by tag id.
+    Only rebuilt when the layout or fiducial size changes.
+    """
+
+    version = -1
+    layout = None
+    fiducial_size = None
+    object_points = numpy.zeros((0, 4, 3))
+    present = numpy.zeros(0, dtype=bool)
+    tag_poses = {}
+
+    def update(self, config: Config) -> None:
+        if config.version == self.version:
+            return
+        self.version = config.version
+
+        if config.remote.fiducial_layout is self.layout and config.remote.fiducial_size == self.fiducial_size:
+            return
+
+        self.layout = config.remote.fiducial_layout
+        self.fiducial_size = config.remote.fiducial_size
+        fid_size = self.fiducial_size
+
+        max_id = max(self.layout.keys(), default=-1)
+        self.object_points = numpy.zeros((max_id + 1, 4, 3))
+        self.present = numpy.zeros(max_id + 1, dtype=bool)
+        self.tag_poses = {}
+
+        for tid, values in self.layout.items():
+            if tid < 0:
+                continue
+
+            tag_pose = Pose3d(
+                Translation3d(values[0], values[1], values[2]),
+                Rotation3d(values[3], values[4], values[5]))
+
+            corner_0 = tag_pose + Transform3d(Translation3d(0, fid_size / 2.0, -fid_size / 2.0), Rotation3d())
+            corner_1 = tag_pose + Transform3d(Translation3d(0, -fid_size / 2.0, -fid_size / 2.0), Rotation3d())
+            corner_2 = tag_pose + Transform3d(Translation3d(0, -fid_size / 2.0, fid_size / 2.0), Rotation3d())
+            corner_3 = tag_pose + Transform3d(Translation3d(0, fid_size / 2.0, fid_size / 2.0), Rotation3d())
+
+            self.object_points[tid] = [
+                wpitocv(corner_0.translation()),
+                wpitocv(corner_1.translation()),
+                wpitocv(corner_2.translation()),
+                wpitocv(corner_3.translation())
+            ]
+            self.present[tid] = True
+            self.tag_poses[tid] = tag_pose
+
+    def points(self, fiducial):
+        ids = numpy.fromiter((tid for tid, _ in fiducial), dtype=numpy.int64, count=len(fiducial))
+
+        valid = (ids >= 0) & (ids < len(self.present))
+        valid[valid] = self.present[ids[valid]]
+
+        if not valid.any():
+            return [], None, None
+
+        object_points = self.object_points[ids[valid]].reshape(-1, 3)
+        image_points = numpy.concatenate([corners for (_, corners), v in zip(fiducial, valid) if v]).reshape(-1, 2).astype(numpy.float64)
+
+        return ids[valid].tolist(), object_points, image_points
+
 class FiducialPoseEstimator(PoseEstimator):
 
     fiducial_size = 0.0
     camera_matrix = None
     distortion_coefficient = None
 
-    def __init__(self, config: Config):
+    # The last accepted solution, reused as the starting guess while the same tags stay in view
+    tracked_ids = None
+    tracked_rvec = None
+    tracked_tvec = None
+    tracked_error = 0.0
+    tracked_version = -1
+
+    # Reprojection error ratio of the best to the second best single-tag solution of the last frame, 0 when unambiguous
+    ambiguity = 0.0
+    # Mean distance from the camera to the tags used in the last pose, in meters
+    tag_distance = 0.0
+    # With pose_filter, tags with a reprojection error past max(outlier_error, outlier_ratio * median) are left out of multi-tag solves
+    outlier_error = 2.0
+    outlier_ratio = 3.0
+
+    def __init__(self, config: Config, layout: FiducialLayout = None):
         self.camera_matrix = config.local.camera_matrix
         self.distortion_coefficient = config.local.distortion_coefficient
+        self.layout = layout if layout is not None else FiducialLayout()
+        self.pose_tracking = config.local.pose_tracking
+        self.reject_outliers = config.local.pose_filter
+        self.resolver = AmbiguityResolver(config)
     
     def process(self, fiducial, config: Config):
 
-        if fiducial is None or len(fiducial) == 0: return (None, None, None)
+        self.ambiguity = 0.0
 
-        object_points = []
-        image_points = []
-        tag_ids = []
-        tag_poses = []
+        if fiducial is None or len(fiducial) == 0:
+            self.tracked_ids = None
+            return (None, None, None)
 
-        tag_layout = config.remote.fiducial_layout
         fid_size = config.remote.fiducial_size
 
-        for tid, corners in fiducial:
-            if tid in tag_layout:
-                tag_pose = Pose3d(
-                    Translation3d(
-                        tag_layout[tid][0],
-                        tag_layout[tid][1],
-                        tag_layout[tid][2],
-                    ),
-                    Rotation3d(
-                        tag_layout[tid][3],
-                        tag_layout[tid][4],
-                        tag_layout[tid][5],
-                    ))
-                
-                corner_0 = tag_pose + Transform3d(Translation3d(0, fid_size / 2.0, -fid_size / 2.0), Rotation3d())
-                corner_1 = tag_pose + Transform3d(Translation3d(0, -fid_size / 2.0, -fid_size / 2.0), Rotation3d())
-                corner_2 = tag_pose + Transform3d(Translation3d(0, -fid_size / 2.0, fid_size / 2.0), Rotation3d())
-                corner_3 = tag_pose + Transform3d(Translation3d(0, fid_size / 2.0, fid_size / 2.0), Rotation3d())
-                object_points += [
-                    wpitocv(corner_0.translation()),
-                    wpitocv(corner_1.translation()),
-                    wpitocv(corner_2.translation()),
-                    wpitocv(corner_3.translation())
-                ]
-
-                image_points += [
-                    [corners[0][0][0], corners[0][0][1]],
-                    [corners[0][1][0], corners[0][1][1]],
-                    [corners[0][2][0], corners[0][2][1]],
-                    [corners[0][3][0], corners[0][3][1]]
-                ]
-
-                tag_ids += [tid]
-                tag_poses += [tag_pose]
+        # The calibration changes with the camera resolution, and a tracked solution from the old one is no use
+        if config.local.camera_matrix is not self.camera_matrix:
+            self.camera_matrix = config.local.camera_matrix
+            self.distortion_coefficient = config.local.distortion_coefficient
+            self.tracked_ids = None
+
+        self.layout.update(config)
+        tag_ids, object_points, image_points = self.layout.points(fiducial)
+
+        if len(tag_ids) == 0:
+            self.tracked_ids = None
+            return (None, None, None)
 
         if len(tag_ids) == 1:
             object_points = numpy.array([[-fid_size / 2.0, fid_size / 2.0, 0.0],
                                          [fid_size / 2.0, fid_size / 2.0, 0.0],
                                          [fid_size / 2.0, -fid_size / 2.0, 0.0],
                                          [-fid_size / 2.0, -fid_size / 2.0, 0.0]])
+
+        solution = self.track(tag_ids, object_points, image_points, config) if self.pose_tracking else None
+
+        if solution is not None:
+            rvec, tvec, error = solution
+            field_to_camera_pose = self.cameraPose(tag_ids, rvec, tvec)
+        else:
             try:
-                _, rvecs, tvecs, errors = cv2.solvePnPGeneric(object_points, numpy.array(image_points),
-                                                              self.camera_matrix, self.distortion_coefficient, flags=cv2.SOLVEPNP_IPPE_SQUARE)
+                _, rvecs, tvecs, errors = cv2.solvePnPGeneric(object_points, image_points, self.camera_matrix, self.distortion_coefficient,
+                                                              flags=cv2.SOLVEPNP_IPPE_SQUARE if len(tag_ids) == 1 else cv2.SOLVEPNP_SQPNP)
             except:
+                self.tracked_ids = None
                 return (None, None, None)
-        
-            # Calculate WPILib camera poses
-            field_to_tag_pose = tag_poses[0]
-            camera_to_tag_pose_0 = cvtowpi(tvecs[0], rvecs[0])
-            camera_to_tag_pose_1 = cvtowpi(tvecs[1], rvecs[1])
-            camera_to_tag_0 = Transform3d(camera_to_tag_pose_0.translation(), camera_to_tag_pose_0.rotation())
-            camera_to_tag_1 = Transform3d(camera_to_tag_pose_1.translation(), camera_to_tag_pose_1.rotation())
-            field_to_camera_0 = field_to_tag_pose.transformBy(camera_to_tag_0.inverse())
-            field_to_camera_1 = field_to_tag_pose.transformBy(camera_to_tag_1.inverse())
-            field_to_camera_pose_0 = Pose3d(field_to_camera_0.translation(), field_to_camera_0.rotation())
-            field_to_camera_pose_1 = Pose3d(field_to_camera_1.translation(), field_to_camera_1.rotation())
-
-            return (tag_ids, field_to_camera_pose_0, errors[0][0])
-
-            # if errors[0][0] < errors[1][0] * 0.15: 
-            #     return (tag_ids, field_to_camera_pose_0, errors[0][0])
-            # if errors[1][0] < errors[0][0] * 0.15: 
-            #     return (tag_ids, field_to_camera_pose_1, errors[1][0])
-            
-            # return (None, None, None)
+
+            # A single tag has two solutions that can reproject almost equally well, pick the one that agrees with recent poses
+            candidates = [self.cameraPose(tag_ids, rvecs[i], tvecs[i]) for i in range(len(rvecs))]
+            index, self.ambiguity = self.resolver.resolve(candidates, [e[0] for e in errors])
+            if index is None:
+                self.tracked_ids = None
+                return (None, None, None)
+
+            rvec, tvec, error = rvecs[index], tvecs[index], errors[index][0]
+            field_to_camera_pose = candidates[index]
+
+        if self.reject_outliers and len(tag_ids) > 2:
+            inliers = self.inliers(tag_ids, object_points, image_points, rvec, tvec)
+            if inliers is not None:
+                return self.process([f for f in fiducial if f[0] in inliers], config)
+
+        self.tracked_ids = tag_ids
+        self.tracked_rvec = rvec
+        self.tracked_tvec = tvec
+        self.tracked_error = error
+        self.tracked_version = config.version
+        self.resolver.accept(field_to_camera_pose)
+        self.tag_distance = sum(field_to_camera_pose.translation().distance(self.layout.tag_poses[tid].translation()) for tid in tag_ids) / len(tag_ids)
+
+        return (tag_ids, field_to_camera_pose, error)
+
+    def inliers(self, tag_ids, object_points, image_points, rvec, tvec):
+        """The ids of the tags that agree with the solution, or None if every tag does."""
+        projected, _ = cv2.projectPoints(object_points, rvec, tvec, self.camera_matrix, self.distortion_coefficient)
+        errors = numpy.sqrt(numpy.mean(((projected.reshape(-1, 2) - image_points) ** 2).reshape(len(tag_ids), 8), axis=1))
+        keep = errors <= max(self.outlier_error, self.outlier_ratio * numpy.median(errors))
+        if keep.all() or keep.sum() < 2:
+            return None
+        return {tid for tid, k in zip(tag_ids, keep) if k}
+
+    def cameraPose(self, tag_ids, rvec, tvec) -> Pose3d:
+        if len(tag_ids) == 1:
+            # Calculate WPILib camera pose
+            field_to_tag_pose = self.layout.tag_poses[tag_ids[0]]
+            camera_to_tag_pose = cvtowpi(tvec, rvec)
+            camera_to_tag = Transform3d(camera_to_tag_pose.translation(), camera_to_tag_pose.rotation())
+            field_to_camera = field_to_tag_pose.transformBy(camera_to_tag.inverse())
+            return Pose3d(field_to_camera.translation(), field_to_camera.rotation())
         
         # Multi-tag, return one pose
         else:
-            # Run SolvePNP with all tags
-            try:
-                _, rvecs, tvecs, errors = cv2.solvePnPGeneric(numpy.array(object_points), numpy.array(image_points),
-                                                              self.camera_matrix, self.distortion_coefficient, flags=cv2.SOLVEPNP_SQPNP)
-            except:
-                return (None, None, None)
-
             # Calculate WPILib camera pose
-            camera_to_field_pose = cvtowpi(tvecs[0], rvecs[0])
+            camera_to_field_pose = cvtowpi(tvec, rvec)
             camera_to_field = Transform3d(camera_to_field_pose.translation(), camera_to_field_pose.rotation())
             field_to_camera = camera_to_field.inverse()
-            field_to_camera_pose = Pose3d(field_to_camera.translation(), field_to_camera.rotation())
+            return Pose3d(field_to_camera.translation(), field_to_camera.rotation())
+
+    def track(self, tag_ids, object_points, image_points, config: Config):
+        """
+        Refines the previous frame's solution instead of solving from scratch. Returns None so the global solver
+        runs instead when the visible tags or config changed or the refined reprojection error jumps. Staying on
+        the previous solution also keeps single tags from flipping between the two IPPE solutions.
+        """
+        if self.tracked_ids != tag_ids or self.tracked_version != config.version:
+            return None
+
+        # solvePnPRefineLM often stops short of the minimum here, the iterative solver with a guess converges reliably
+        try:
+            count, rvecs, tvecs, errors = cv2.solvePnPGeneric(object_points, image_points, self.camera_matrix, self.distortion_coefficient,
+                                                              flags=cv2.SOLVEPNP_ITERATIVE, useExtrinsicGuess=True,
+                                                              rvec=self.tracked_rvec.copy(), tvec=self.tracked_tvec.copy())
+        except:
+            return None
+        if count == 0:
+            return None
+        rvec, tvec, error = rvecs[0], tvecs[0], errors[0][0]
+
+        if error > self.tracked_error * 2 + 0.5:
+            return None
+        return (rvec, tvec, error)
+
+class AmbiguityResolver:
+    """
+    Chooses between the two solutions of a single tag. Takes the lower error one when it is clearly better,
+    otherwise the one closest to the recently accepted poses and to the robot's gyro heading, if the robot
+    publishes it to /<device_name>/input/robot_heading. Frames that neither can settle are dropped.
+    """
+
+    history_size = 10
+    # Accepted poses older than this, in seconds, say nothing about where the camera is now
+    max_age = 0.5
+    # The winning candidate has to score at most this fraction of the other one
+    margin = 0.5
+
+    def __init__(self, config: Config):
+        self.threshold = config.local.ambiguity_threshold
+        self.robot_to_camera = robotToCamera(config)
+        self.history = deque(maxlen=self.history_size)
+        self.heading_sub = None
+        if config.local.use_gyro:
+            self.heading_sub = NetworkTableInstance.getDefault().getTable(config.local.device_name).getSubTable("input") \
+                .getDoubleTopic("robot_heading").subscribe(math.nan)
+
+    def accept(self, pose: Pose3d) -> None:
+        self.history.append((time.monotonic(), pose))
+
+    def resolve(self, candidates: list, errors: list):
+        """Returns the index of the chosen candidate, or None to drop the frame, and the ambiguity ratio."""
+        if len(candidates) < 2:
+            return 0, 0.0
+
+        ambiguity = errors[0] / errors[1] if errors[1] > 0 else 1.0
+        # At 1.0 or more the lowest error solution is always taken, as before the resolver
+        if ambiguity < self.threshold or self.threshold >= 1.0:
+            return 0, ambiguity
+
+        scores = [self.score(candidate) for candidate in candidates[:2]]
+        if scores[0] is None:
+            return None, ambiguity
+
+        best = 0 if scores[0] <= scores[1] else 1
+        if scores[best] > scores[1 - best] * self.margin:
+            return None, ambiguity
+        return best, ambiguity
+
+    def score(self, pose: Pose3d):
+        """Distance from the newest recent pose (m + rad) plus the heading difference from the gyro (rad), or None without either."""
+        score = None
+        now = time.monotonic()
+
+        if len(self.history) > 0 and now - self.history[-1][0] < self.max_age:
+            difference = pose.relativeTo(self.history[-1][1])
+            score = difference.translation().norm() + abs(wrapAngle(difference.rotation().angle))
+
+        if self.heading_sub is not None:
+            heading = self.heading_sub.getAtomic()
+            if not math.isnan(heading.value) and _now() - heading.time < self.max_age * 1e6:
+                robot_pose = pose.transformBy(self.robot_to_camera.inverse())
+                score = (score or 0.0) + abs(wrapAngle(robot_pose.rotation().Z() - heading.value))
+
+        return score
+
+@dataclass
+class CameraObservation:
+    config: Config
+    fiducials: list
+    camera_pose: Pose3d
+    reprojection_error: float
+    timestamp: float
+    areas: list
+
+class MultiCameraPoseEstimator:
+    """
+    Solves one robot pose from every camera's tag observations at once. Each camera's pose is the robot pose
+    composed with its fixed robot_to_camera transform, so all cameras' corners constrain the same six unknowns.
+    Refined with Levenberg-Marquardt from the best per-camera solution.
+    """
+
+    # Observations older than this relative to the newest one are from a different capture window
+    window = 0.05
+    iterations = 20
+
+    def __init__(self, layout: FiducialLayout):
+        self.layout = layout
+
+    def process(self, observations: list, config: Config):
+        observations = [o for o in observations if o is not None and o.camera_pose is not None]
+        if len(observations) == 0: return (None, None, None, None)
+
+        newest = max(o.timestamp for o in observations)
+        observations = [o for o in observations if newest - o.timestamp <= self.window]
+
+        self.layout.update(config)
+
+        cameras = []
+        tag_ids = []
+        for observation in observations:
+            ids, object_points, image_points = self.layout.points(observation.fiducials)
+            if len(ids) == 0:
+                continue
+            robot_to_camera = robotToCamera(observation.config)
+            rvec, tvec = transformtocv(robot_to_camera.inverse())
+            cameras.append((observation, robot_to_camera, rvec, tvec, object_points, image_points))
+            tag_ids += ids
+
+        if len(cameras) == 0: return (None, None, None, None)
+
+        # Start from every camera's own solution and keep whichever converges best, so one
+        # camera's flipped single tag solution cannot drag the others into its local minimum
+        best = None
+        for observation, robot_to_camera, _, _, _, _ in cameras:
+            seed = observation.camera_pose.transformBy(robot_to_camera.inverse())
+            rvec, tvec, error = self.refine(cameras, *transformtocv(Transform3d(seed.translation(), seed.rotation()).inverse()))
+            if best is None or error < best[2]:
+                best = (rvec, tvec, error)
+
+        rvec, tvec, error = best
+        robot_to_field_pose = cvtowpi(tvec, rvec)
+        field_to_robot = Transform3d(robot_to_field_pose.translation(), robot_to_field_pose.rotation()).inverse()
+        robot_pose = Pose3d(field_to_robot.translation(), field_to_robot.rotation())
+        timestamp = sum(o.timestamp for o, _, _, _, _, _ in cameras) / len(cameras)
+
+        return (tag_ids, robot_pose, error, timestamp)
+
+    def refine(self, cameras, rvec, tvec):
+        """Levenberg-Marquardt on the field to robot (rvec, tvec), returning it with its RMS reprojection error."""
+        params = numpy.concatenate([rvec.ravel(), tvec.ravel()])
+        residuals, jacobian = self.residuals(cameras, params)
+        cost = residuals @ residuals
+        damping = 1e-3
+
+        for _ in range(self.iterations):
+            normal = jacobian.T @ jacobian
+            step = numpy.linalg.solve(normal + damping * numpy.diag(numpy.diag(normal) + 1e-9), -jacobian.T @ residuals)
+
+            new_residuals, new_jacobian = self.residuals(cameras, params + step)
+            new_cost = new_residuals @ new_residuals
+            if new_cost < cost:
+                params = params + step
+                residuals, jacobian, cost = new_residuals, new_jacobian, new_cost
+                damping = max(damping / 10, 1e-7)
+                if numpy.linalg.norm(step) < 1e-8:
+                    break
+            else:
+                damping *= 10
+                if damping > 1e6:
+                    break
+
+        return params[:3].reshape(3, 1), params[3:].reshape(3, 1), float(numpy.sqrt(cost / len(residuals)))
+
+    def residuals(self, cameras, params):
+        rvec = params[:3].reshape(3, 1)
+        tvec = params[3:].reshape(3, 1)
+
+        all_residuals = []
+        all_jacobians = []
+        for observation, _, camera_rvec, camera_tvec, object_points, image_points in cameras:
+            # Field to camera = robot to camera after field to robot, with the chain rule back to the robot pose
+            rvec_c, tvec_c, dr_dr, _, _, _, dt_dr, dt_dt, _, _ = cv2.composeRT(rvec, tvec, camera_rvec, camera_tvec)
+            projected, jacobian = cv2.projectPoints(object_points, rvec_c, tvec_c,
+                                                    observation.config.local.camera_matrix, observation.config.local.distortion_coefficient)
+            d_rvec = jacobian[:, 0:3] @ dr_dr + jacobian[:, 3:6] @ dt_dr
+            d_tvec = jacobian[:, 3:6] @ dt_dt
+            all_residuals.append((projected.reshape(-1, 2) - image_points).ravel())
+            all_jacobians.append(numpy.hstack([d_rvec, d_tvec]))
+
+        return numpy.concatenate(all_residuals), numpy.vstack(all_jacobians)
+
+def robotToCamera(config: Config) -> Transform3d:
+    values = config.local.robot_to_camera
+    if values is None or len(values) != 6:
+        return Transform3d()
+    return Transform3d(Translation3d(values[0], values[1], values[2]), Rotation3d(values[3], values[4], values[5]))
 
-            return (tag_ids, field_to_camera_pose, errors[0][0])
+def wrapAngle(angle: float) -> float:
+    return math.atan2(math.sin(angle), math.cos(angle))
@@ -0,0 +1,88 @@
+"""
+Copyright (c) 2023-2024 Ivan Chen, StuyPulse
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/license/MIT.
+"""
+
+import math
+import numpy
+from wpimath.geometry import *
+
+class PoseFilter:
+    """
+    Constant-velocity Kalman filter on the camera pose, run independently on x, y, z, roll, pitch and yaw.
+    Measurement noise grows with distance to the tags and reprojection error and shrinks with tag count,
+    so the published standard deviations can be used by the robot's pose estimator directly.
+    """
+
+    # Acceleration noise of the constant-velocity model, in m/s^2 and rad/s^2
+    translation_acceleration = 4.0
+    rotation_acceleration = 8.0
+    # Measurement noise per meter squared (translation) and per meter (rotation) of distance to the tags
+    translation_noise = 0.004
+    rotation_noise = 0.008
+    # 99.9% chi-squared bound for 6 degrees of freedom, measurements past it are treated as outliers
+    gate = 22.46
+    max_rejections = 3
+    max_gap = 0.5
+
+    def __init__(self):
+        self.state = None
+        self.covariance = None
+        self.timestamp = 0.0
+        self.rejections = 0
+
+    def update(self, pose: Pose3d, reprojection_error: float, tag_count: int, tag_distance: float, timestamp: float):
+        """Returns the filtered pose and its [x, y, z, roll, pitch, yaw] standard deviations, or (None, None) if the measurement was rejected."""
+        measurement = numpy.array([pose.X(), pose.Y(), pose.Z(), pose.rotation().X(), pose.rotation().Y(), pose.rotation().Z()])
+
+        scale = (1 + reprojection_error) / math.sqrt(max(tag_count, 1))
+        translation_std = max(self.translation_noise * tag_distance ** 2 * scale, 0.005)
+        rotation_std = max(self.rotation_noise * tag_distance * scale, 0.005)
+        noise = numpy.array([translation_std] * 3 + [rotation_std] * 3) ** 2
+
+        dt = timestamp - self.timestamp
+        if self.state is None or dt > self.max_gap or dt < 0 or self.rejections >= self.max_rejections:
+            self.reset(measurement, noise, timestamp)
+            return pose, numpy.sqrt(noise).tolist()
+
+        self.predict(dt)
+
+        innovation = measurement - self.state[:, 0]
+        innovation[3:] = numpy.arctan2(numpy.sin(innovation[3:]), numpy.cos(innovation[3:]))
+        innovation_covariance = self.covariance[:, 0, 0] + noise
+
+        if numpy.sum(innovation ** 2 / innovation_covariance) > self.gate:
+            self.rejections += 1
+            return None, None
+        self.rejections = 0
+        self.timestamp = timestamp
+
+        # Per axis Kalman gain for the [position, velocity] state
+        gain = self.covariance[:, :, 0] / innovation_covariance[:, None]
+        self.state += gain * innovation[:, None]
+        self.state[3:, 0] = numpy.arctan2(numpy.sin(self.state[3:, 0]), numpy.cos(self.state[3:, 0]))
+        self.covariance -= gain[:, :, None] * self.covariance[:, None, 0, :]
+
+        return self.pose(), numpy.sqrt(self.covariance[:, 0, 0]).tolist()
+
+    def predict(self, dt: float) -> None:
+        self.state[:, 0] += self.state[:, 1] * dt
+        transition = numpy.array([[1, dt], [0, 1]])
+        acceleration = numpy.array([self.translation_acceleration] * 3 + [self.rotation_acceleration] * 3) ** 2
+        process = numpy.array([[dt ** 3 / 3, dt ** 2 / 2], [dt ** 2 / 2, dt]])
+        self.covariance = transition @ self.covariance @ transition.T + acceleration[:, None, None] * process
+
+    def reset(self, measurement, noise, timestamp: float) -> None:
+        self.state = numpy.stack([measurement, numpy.zeros(6)], axis=1)
+        self.covariance = numpy.zeros((6, 2, 2))
+        self.covariance[:, 0, 0] = noise
+        self.covariance[:, 1, 1] = 1.0
+        self.timestamp = timestamp
+        self.rejections = 0
+
+    def pose(self) -> Pose3d:
+        x, y, z, roll, pitch, yaw = self.state[:, 0]
+        return Pose3d(Translation3d(x, y, z), Rotation3d(roll, pitch, yaw))
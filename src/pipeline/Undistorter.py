@@ -0,0 +1,67 @@
+"""
+Copyright (c) 2023-2024 Ivan Chen, StuyPulse
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/license/MIT.
+"""
+
+import hashlib
+import os
+import cv2
+import numpy
+
+class Undistorter:
+    """
+    Removes lens distortion either from whole frames ("frame", before detection) or from detected corners ("points",
+    after detection). Both produce points in the same rectified image, described by camera_matrix with no distortion,
+    so everything downstream can skip the distortion model.
+    """
+
+    # 0 crops the rectified image to valid pixels only, 1 keeps every source pixel, including the corners of wide lenses
+    alpha = 0.0
+
+    def __init__(self, camera_matrix, distortion_coefficient, resolution, mode: str, cache_file: str):
+        self.mode = mode
+        self.source_camera_matrix = camera_matrix
+        self.source_distortion_coefficient = distortion_coefficient
+        self.camera_matrix = None
+        self.distortion_coefficient = numpy.zeros((1, 5))
+        self.map1 = None
+        self.map2 = None
+
+        height, width = int(resolution[0]), int(resolution[1])
+        key = hashlib.sha1(numpy.asarray(camera_matrix, dtype=numpy.float64).tobytes() + numpy.asarray(distortion_coefficient, dtype=numpy.float64).tobytes() +
+                           str((height, width, self.alpha)).encode()).hexdigest()
+
+        # The maps are kept next to the calibration file and only rebuilt when the calibration or resolution changes
+        if mode == "frame" and os.path.isfile(cache_file):
+            cached = numpy.load(cache_file)
+            if str(cached["key"]) == key:
+                self.camera_matrix, self.map1, self.map2 = cached["camera_matrix"], cached["map1"], cached["map2"]
+                return
+
+        self.camera_matrix, _ = cv2.getOptimalNewCameraMatrix(camera_matrix, distortion_coefficient, (width, height), self.alpha)
+
+        if mode == "frame":
+            self.map1, self.map2 = cv2.initUndistortRectifyMap(camera_matrix, distortion_coefficient, None, self.camera_matrix, (width, height), cv2.CV_16SC2)
+            numpy.savez(cache_file, key=key, camera_matrix=self.camera_matrix, map1=self.map1, map2=self.map2)
+
+    def undistortFrame(self, image, color: bool = False):
+        """Remaps a frame into the rectified image, converting it to grayscale first unless color is set since detection only needs one channel."""
+        if self.mode != "frame":
+            return image
+        if not color and image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return cv2.remap(image, self.map1, self.map2, cv2.INTER_LINEAR)
+
+    def undistortCorners(self, fiducials, all_corners):
+        """Returns the fiducials and corners moved into the rectified image."""
+        if self.mode != "points" or all_corners is None:
+            return fiducials, all_corners
+
+        corners = cv2.undistortPoints(numpy.concatenate(all_corners).reshape(-1, 1, 2).astype(numpy.float64), self.source_camera_matrix,
+                                      self.source_distortion_coefficient, P=self.camera_matrix)
+        all_corners = tuple(corners.astype(numpy.float32).reshape(-1, 1, 4, 2))
+        fiducials = [(tid, corners) for (tid, _), corners in zip(fiducials, all_corners)]
+        return fiducials, all_corners
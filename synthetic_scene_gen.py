@@ -0,0 +1,205 @@
+"""
+Copyright (c) 2023-2024 Ivan Chen, StuyPulse
+
+Use of this source code is governed by an MIT-style
+license that can be found in the LICENSE file or at
+https://opensource.org/license/MIT.
+"""
+
+# Renders fiducial layouts into synthetic camera frames with known camera poses
+# Outputs the frames and a ground truth file that benchmark.py can compare estimated poses against
+
+import argparse
+import json
+import math
+import os
+
+import cv2
+import numpy
+from wpimath.geometry import Pose3d, Rotation3d, Transform3d, Translation3d
+
+FAMILY_DICT = {
+    '4X4_50': cv2.aruco.DICT_4X4_50,
+    '4X4_100': cv2.aruco.DICT_4X4_100,
+    '4X4_250': cv2.aruco.DICT_4X4_250,
+    '4X4_1000': cv2.aruco.DICT_4X4_1000,
+    '5X5_50': cv2.aruco.DICT_5X5_50,
+    '5X5_100': cv2.aruco.DICT_5X5_100,
+    '5X5_250': cv2.aruco.DICT_5X5_250,
+    '5X5_1000': cv2.aruco.DICT_5X5_1000,
+    '6X6_50': cv2.aruco.DICT_6X6_50,
+    '6X6_100': cv2.aruco.DICT_6X6_100,
+    '6X6_250': cv2.aruco.DICT_6X6_250,
+    '6X6_1000': cv2.aruco.DICT_6X6_1000,
+    '7X7_50': cv2.aruco.DICT_7X7_50,
+    '7X7_100': cv2.aruco.DICT_7X7_100,
+    '7X7_250': cv2.aruco.DICT_7X7_250,
+    '7X7_1000': cv2.aruco.DICT_7X7_1000,
+    'ARUCO_ORIGINAL': cv2.aruco.DICT_ARUCO_ORIGINAL,
+    'APRILTAG_16H5': cv2.aruco.DICT_APRILTAG_16h5,
+    'APRILTAG_25H9': cv2.aruco.DICT_APRILTAG_25h9,
+    'APRILTAG_36H10': cv2.aruco.DICT_APRILTAG_36h10,
+    'APRILTAG_36H11': cv2.aruco.DICT_APRILTAG_36h11
+}
+
+def tagCorners(values, fiducial_size):
+    """Field-frame corners of a tag, in the same order src/pipeline/PoseEstimator.py assigns to detected corners."""
+    tag_pose = Pose3d(Translation3d(values[0], values[1], values[2]), Rotation3d(values[3], values[4], values[5]))
+    half = fiducial_size / 2.0
+    return [(tag_pose + Transform3d(Translation3d(0, y, z), Rotation3d())).translation()
+            for y, z in [(half, -half), (-half, -half), (-half, half), (half, half)]]
+
+def toCamera(camera_pose: Pose3d, point: Translation3d):
+    """Returns a field point in OpenCV camera axes (x right, y down, z forward)."""
+    t = Pose3d(point, Rotation3d()).relativeTo(camera_pose).translation()
+    return [-t.Y(), -t.Z(), t.X()]
+
+def markerImage(dictionary, tid: int, cell_pixels: int):
+    """Marker with a one cell white quiet zone, and the coordinates of its black border's outer corners."""
+    cells = dictionary.markerSize + 2
+    marker = cv2.aruco.generateImageMarker(dictionary, tid, cells * cell_pixels)
+    image = cv2.copyMakeBorder(marker, cell_pixels, cell_pixels, cell_pixels, cell_pixels, cv2.BORDER_CONSTANT, value=255)
+    lo = cell_pixels - 0.5
+    hi = cell_pixels + cells * cell_pixels - 0.5
+    return image, numpy.float32([[lo, lo], [hi, lo], [hi, hi], [lo, hi]])
+
+def distortionMaps(camera_matrix, distortion_coefficient, size):
+    """Maps each distorted output pixel to its location in the ideal pinhole image."""
+    width, height = size
+    grid = numpy.stack(numpy.meshgrid(numpy.arange(width, dtype=numpy.float32), numpy.arange(height, dtype=numpy.float32)), axis=-1)
+    ideal = cv2.undistortPoints(grid.reshape(-1, 1, 2), camera_matrix, distortion_coefficient, P=camera_matrix)
+    ideal = ideal.reshape(height, width, 2)
+    return ideal[:, :, 0].copy(), ideal[:, :, 1].copy()
+
+def render(camera_pose, layout, fiducial_size, dictionary, camera_matrix, maps, size, args, rng):
+    width, height = size
+    ys, xs = numpy.mgrid[0:height, 0:width]
+    scene = (110 + 30 * numpy.sin(xs / 173.0) * numpy.cos(ys / 131.0)).astype(numpy.float32)
+
+    visible = []
+    for tid, values in layout.items():
+        points = numpy.float64([toCamera(camera_pose, c) for c in tagCorners(values, fiducial_size)])
+        if numpy.any(points[:, 2] < 0.05):
+            continue
+
+        projected, _ = cv2.projectPoints(points, numpy.zeros(3), numpy.zeros(3), camera_matrix, None)
+        projected = projected.reshape(4, 2).astype(numpy.float32)
+
+        # Only keep tags whose front face points at the camera
+        edge_a = projected[1] - projected[0]
+        edge_b = projected[3] - projected[0]
+        if edge_a[0] * edge_b[1] - edge_a[1] * edge_b[0] <= 0:
+            continue
+
+        # Size the source marker close to its projected size so the warp does not alias
+        side = numpy.linalg.norm(projected - numpy.roll(projected, 1, axis=0), axis=1).max()
+        image, source = markerImage(dictionary, tid, int(numpy.clip(round(side / (dictionary.markerSize + 2)), 2, 40)))
+        homography = cv2.getPerspectiveTransform(source, projected)
+
+        warped = cv2.warpPerspective(image.astype(numpy.float32), homography, size, flags=cv2.INTER_LINEAR)
+        mask = cv2.warpPerspective(numpy.ones(image.shape, numpy.float32), homography, size, flags=cv2.INTER_LINEAR)
+        scene = scene * (1 - mask) + warped * mask
+
+        if numpy.all((projected >= 0) & (projected < [width, height])):
+            visible.append(tid)
+
+    scene = cv2.remap(scene, maps[0], maps[1], cv2.INTER_LINEAR, borderValue=110)
+
+    scene *= args.exposure
+    if args.blur > 0:
+        scene = cv2.GaussianBlur(scene, (0, 0), args.blur)
+    if args.motion_blur > 1:
+        kernel = numpy.zeros((args.motion_blur, args.motion_blur), numpy.float32)
+        kernel[args.motion_blur // 2, :] = 1.0 / args.motion_blur
+        rotation = cv2.getRotationMatrix2D(((args.motion_blur - 1) / 2, (args.motion_blur - 1) / 2), rng.uniform(0, 180), 1.0)
+        kernel = cv2.warpAffine(kernel, rotation, kernel.shape)
+        scene = cv2.filter2D(scene, -1, kernel / max(kernel.sum(), 1e-6))
+    if args.noise > 0:
+        scene += rng.normal(0, args.noise, scene.shape).astype(numpy.float32)
+
+    return cv2.cvtColor(numpy.clip(scene, 0, 255).astype(numpy.uint8), cv2.COLOR_GRAY2BGR), visible
+
+def randomPose(layout, rng):
+    """A camera pose 1 to 5 m in front of a random tag, roughly facing it."""
+    tid = list(layout.keys())[rng.integers(len(layout))]
+    tag = layout[tid]
+    heading = tag[5] + rng.uniform(-0.7, 0.7)
+    distance = rng.uniform(1.0, 5.0)
+    x = tag[0] + distance * math.cos(heading)
+    y = tag[1] + distance * math.sin(heading)
+    z = rng.uniform(0.2, 1.0)
+    yaw = math.atan2(tag[1] - y, tag[0] - x) + rng.uniform(-0.2, 0.2)
+    pitch = -math.atan2(tag[2] - z, distance) + rng.uniform(-0.05, 0.05)
+    return [x, y, z, rng.uniform(-0.03, 0.03), pitch, yaw]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render synthetic fiducial frames with ground truth camera poses.")
+    parser.add_argument("--layout", required=True, help="layout JSON file with fiducial_layout as [id, x, y, z, roll, pitch, yaw, ...] and fiducial_size")
+    parser.add_argument("--calibration", default="./src/config/data/calibration.json", help="calibration file written by manual_calibration.py")
+    parser.add_argument("--dictionary", default="APRILTAG_36H11", choices=FAMILY_DICT.keys())
+    parser.add_argument("--poses", help="JSON file with a list of [x, y, z, roll, pitch, yaw] camera poses")
+    parser.add_argument("--random", type=int, default=20, help="number of random camera poses if --poses is not given")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--blur", type=float, default=0.0, help="gaussian blur sigma in pixels")
+    parser.add_argument("--motion-blur", type=int, default=0, help="motion blur length in pixels")
+    parser.add_argument("--noise", type=float, default=0.0, help="gaussian noise sigma in gray levels")
+    parser.add_argument("--exposure", type=float, default=1.0, help="brightness multiplier")
+    parser.add_argument("--output", default="synthetic_output", help="output folder")
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(args.seed)
+
+    with open(args.layout, "r") as file:
+        layout_data = json.load(file)
+    network_layout = layout_data["fiducial_layout"]
+    fiducial_size = layout_data["fiducial_size"]
+    layout = {int(network_layout[i * 7]): network_layout[i * 7 + 1:i * 7 + 7] for i in range(len(network_layout) // 7)}
+
+    with open(args.calibration, "r") as file:
+        calibration = json.load(file)
+    # Calibration files hold one calibration per resolution, render at the first (largest) one
+    if "calibrations" in calibration:
+        calibration = calibration["calibrations"][0]
+    camera_matrix = numpy.asarray(calibration["camera_matrix"])
+    distortion_coefficient = numpy.asarray(calibration["distortion_coefficient"])
+    size = (calibration["resolution"][1], calibration["resolution"][0])
+
+    dictionary = cv2.aruco.getPredefinedDictionary(FAMILY_DICT[args.dictionary])
+
+    if args.poses is not None:
+        with open(args.poses, "r") as file:
+            poses = json.load(file)
+    else:
+        poses = [randomPose(layout, rng) for _ in range(args.random)]
+
+    if not os.path.exists(args.output):
+        os.mkdir(args.output)
+
+    maps = distortionMaps(camera_matrix, distortion_coefficient, size)
+    frames = []
+
+    for i, pose in enumerate(poses):
+        camera_pose = Pose3d(Translation3d(pose[0], pose[1], pose[2]), Rotation3d(pose[3], pose[4], pose[5]))
+        image, visible = render(camera_pose, layout, fiducial_size, dictionary, camera_matrix, maps, size, args, rng)
+
+        name = str(i).zfill(6) + ".png"
+        cv2.imwrite(os.path.join(args.output, name), image)
+        frames.append({"image": name, "pose": pose, "visible_tags": visible})
+        print("Rendered " + name + " with tags " + str(visible))
+
+    output = {
+        "calibration": args.calibration,
+        "dictionary": args.dictionary,
+        "fiducial_size": fiducial_size,
+        "fiducial_layout": network_layout,
+        "blur": args.blur,
+        "motion_blur": args.motion_blur,
+        "noise": args.noise,
+        "exposure": args.exposure,
+        "frames": frames
+    }
+
+    with open(os.path.join(args.output, "ground_truth.json"), "w") as file:
+        file.write(json.dumps(output, indent=4))
+
+    print("Wrote ground truth to " + os.path.join(args.output, "ground_truth.json"))